@@ -3,6 +3,17 @@ from collections import namedtuple
 class Node(object):
     srcmap = None
 
+def walk(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        for value in vars(node).values():
+            if isinstance(value, Node):
+                stack.append(value)
+            elif isinstance(value, list):
+                stack.extend(item for item in value if isinstance(item, Node))
+
 class Type(Node):
     pass
     
@@ -72,12 +83,21 @@ class Term(Expression):
         return 'Term(%s)' % self.name
 
 class Tuple(Type):
-    def __init__(self, members):
+    # record fields are Vars, the fields of plain tuples are named by position
+    def __init__(self, members, name=None):
         self.members = members
+        self.name = name
 
     def __str__(self):
         return 'Tuple(%s)' % ', '.join(map(str, self.members))
 
+class Ref(Type):
+    def __init__(self, type):
+        self.type = type
+
+    def __str__(self):
+        return 'Ref(%s)' % self.type
+
 class Value(Expression):
     def __init__(self, value, type):
         self.value = value
@@ -120,9 +140,46 @@ class Program(Block):
     def __str__(self):
         return 'Program %s' % Block.__str__(self)
 
+class Parallel(Expression):
+    def __init__(self, var, lo, hi, reductions, body):
+        self.var = var
+        self.lo = lo
+        self.hi = hi
+        self.reductions = reductions
+        self.body = body
+
+    def __str__(self):
+        reductions = ', '.join('%s(%s)' % r for r in self.reductions)
+        return 'Parallel(%s in %s, %s reduce %s) %s' % (self.var, self.lo, self.hi, reductions, self.body)
+
+class Import(Definition):
+    def __init__(self, module):
+        self.module = module
+
+    def __str__(self):
+        return 'Import(%s)' % self.module
+
 class Enum(Expression):
-    def __init__(self, values):
+    def __init__(self, values, name=None):
         self.values = values
+        self.name = name
         
     def __str__(self):
         return 'Enum(%s)' % ', '.join(self.values)
+
+class Arm(Node):
+    # members of the matched enum taking the arm, None for the else arm
+    def __init__(self, names, body):
+        self.names = names
+        self.body = body
+
+    def __str__(self):
+        return '%s %s' % (', '.join(self.names) if self.names is not None else 'else', self.body)
+
+class Match(Expression):
+    def __init__(self, value, arms):
+        self.value = value
+        self.arms = arms
+
+    def __str__(self):
+        return 'Match(%s, %s)' % (self.value, ', '.join(map(str, self.arms)))
@@ -0,0 +1,163 @@
+#!env python2.7
+import os
+import sys
+import time
+import shutil
+import argparse
+import collections
+import threading
+import multiprocessing
+import multiprocessing.pool
+import model
+import optimizer
+import modules
+import compiler
+import cache
+
+def read_manifest(path):
+    # one program per line, relative to the manifest; blank lines and # comments are skipped
+    base = os.path.dirname(os.path.abspath(path))
+    res = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                res.append(os.path.join(base, line))
+    return res
+
+def output_path(path, output_dir, shared=False):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir, name + (compiler.SHARED_EXT if shared else compiler.EXT))
+
+def describe(e):
+    return '%s: %s' % (type(e).__name__, e)
+
+def frontend(job):
+    # runs in a worker process, only plain strings go back to the parent
+    path, args = job
+    start = time.time()
+    try:
+        profile = compiler.profile_from_args(args)
+        optimize = lambda m: optimizer.optimize_from_args(m, args)
+        loader = modules.loader_from_args(path, args, optimize=optimize, variant=optimizer.variant_from_args(args))
+        with open(path) as f:
+            content = f.read()
+        m = model.build_model(content, loader=loader)
+        optimize(m)
+        profile = compiler.model_profile(m, profile)
+        if m.imports:
+            # objects of unchanged modules are looked up here, the backend links them
+            units = compiler.module_units(m, profile=profile, shared=args.in_process, cache=cache.from_args(args))
+        else:
+            units = [compiler.Unit(None, str(compiler.transpile(m, profile=profile, shared=args.in_process)),
+                                   None, None)]
+        return path, units, profile, None, time.time() - start
+    except Exception as e:
+        return path, None, None, describe(e), time.time() - start
+
+def backend(path, units, dst, profile, binaries, shared):
+    start = time.time()
+    try:
+        if len(units) > 1:
+            # programs are already built in parallel, their modules are not
+            compiler.build_modules(units, dst, profile=profile, cache=binaries, shared=shared, jobs=1)
+        elif binaries is None:
+            source = units[0].source
+            compiler.build(lambda stream: stream.write(source), dst, profile=profile, shared=shared)
+        else:
+            source = units[0].source
+            build = lambda tmp: compiler.build(lambda stream: stream.write(source), tmp, profile=profile,
+                                               cache=binaries, shared=shared)
+            with binaries.binary(source, compiler.cache_flags(profile, shared), build,
+                                 compiler.HEADERS + [compiler.RUNTIME]) as binary:
+                shutil.copy2(binary, dst)
+        return path, dst, None, time.time() - start
+    except Exception as e:
+        return path, dst, describe(e), time.time() - start
+
+class Report(object):
+    # results are printed as they complete, from the main thread and the gcc threads
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.succeeded = 0
+        self.failed = 0
+
+    def result(self, path, stage, message, elapsed, dst=None):
+        with self.lock:
+            if message is None:
+                self.succeeded += 1
+                self.stream.write('ok    %s -> %s (%.2fs)\n' % (path, dst, elapsed))
+            else:
+                self.failed += 1
+                self.stream.write('FAIL  %s [%s] (%.2fs)\n' % (path, stage, elapsed))
+                self.stream.write(''.join('      %s\n' % line for line in message.splitlines()))
+            self.stream.flush()
+
+    def summary(self):
+        return '%s succeeded, %s failed' % (self.succeeded, self.failed)
+
+def run(paths, args, output_dir, report):
+    shared = args.in_process
+    binaries = cache.from_args(args)
+    jobs = args.jobs or multiprocessing.cpu_count()
+    outputs = collections.OrderedDict()
+    for path in paths:
+        dst = output_path(path, output_dir, shared)
+        if dst in outputs:
+            report.result(path, 'output', 'same output as %s: %s' % (outputs[dst], dst), 0.0)
+        else:
+            outputs[dst] = path
+    frontends = multiprocessing.Pool(jobs)
+    gcc = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        todo = [(path, args) for dst, path in outputs.items()]
+        for path, units, profile, message, elapsed in frontends.imap_unordered(frontend, todo):
+            if message is not None:
+                report.result(path, 'frontend', message, elapsed)
+                continue
+            callback = lambda res: report.result(res[0], 'gcc', res[2], res[3], res[1])
+            dst = output_path(path, output_dir, shared)
+            gcc.apply_async(backend, (path, units, dst, profile, binaries, shared), callback=callback)
+        frontends.close()
+        gcc.close()
+        gcc.join()
+    except:
+        frontends.terminate()
+        gcc.terminate()
+        raise
+    finally:
+        frontends.join()
+
+def main(argv=None, report=None):
+    # the exit status, 1 if any program failed
+    parser = argparse.ArgumentParser(description='compile many programs, front ends and gcc run in parallel')
+    parser.add_argument('path', nargs='*')
+    parser.add_argument('-m', '--manifest', action='append', default=[], metavar='PATH',
+                        help='file with one program path per line')
+    parser.add_argument('-d', '--output-dir', default='.', metavar='DIR', help='binaries are named after programs')
+    optimizer.add_arguments(parser)
+    cache.add_arguments(parser)
+    modules.add_arguments(parser)
+    compiler.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    paths = list(args.path)
+    for manifest in args.manifest:
+        paths += read_manifest(manifest)
+    if not paths:
+        parser.error('no programs given')
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    if report is None:
+        report = Report()
+    run(paths, args, args.output_dir, report)
+    sys.stderr.write(report.summary() + '\n')
+    return 1 if report.failed else 0
+
+if __name__ == '__main__':
+    import logging
+    # failures are reported per program, parser and pass logs would interleave between workers
+    logging.basicConfig(level=logging.CRITICAL)
+    sys.exit(main())
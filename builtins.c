@@ -0,0 +1,422 @@
+#include <stdio.h> // fwrite, fprintf
+#include <signal.h>
+#include <string.h> // memcmp
+#include <time.h>
+#include "builtins.h"
+
+Bool and(Bool a, Bool b) { return a && b; }
+Bool or(Bool a, Bool b) { return a || b; }
+Bool xor(Bool a, Bool b) { return a != b; }
+Bool not(Bool a) { return !a; }
+Bool beq(Bool a, Bool b) { return a == b; }
+Bool bneq(Bool a, Bool b) { return a != b; }
+
+Int add(Int a, Int b) { return a + b; }
+Int sub(Int a, Int b) { return a - b; }
+Int mul(Int a, Int b) { return a * b; }
+// checked like the interpreter does, the smallest Int divided by -1 wraps around
+Int div(Int a, Int b) {
+    if (b == 0) {
+        explo_division_by_zero();
+    }
+    return b == -1 ? (Int)(0 - (unsigned)a) : a / b;
+}
+Int mod(Int a, Int b) {
+    if (b == 0) {
+        explo_division_by_zero();
+    }
+    return b == -1 ? 0 : a % b;
+}
+Bool ieq(Int a, Int b) { return a == b; }
+Bool ineq(Int a, Int b) { return a != b; }
+
+Bool gt(Int a, Int b) { return a > b; }
+Bool geq(Int a, Int b) { return a >= b; }
+Bool lt(Int a, Int b) { return a < b; }
+Bool leq(Int a, Int b) { return a <= b; }
+Int min(Int a, Int b) { return a < b ? a : b; }
+Int max(Int a, Int b) { return a > b ? a : b; }
+
+static char explo_internal[EXPLO_BUFFER_SIZE];
+static char* explo_buffer = explo_internal;
+static unsigned long explo_capacity = EXPLO_BUFFER_SIZE;
+static unsigned long explo_length;
+
+void explo_flush() {
+    if (explo_length) {
+        fwrite(explo_buffer, 1, explo_length, stdout);
+        explo_length = 0;
+    }
+    fflush(stdout);
+}
+
+// output left in a buffer of the caller is read by the caller
+__attribute__((destructor)) static void explo_flush_internal() {
+    if (explo_buffer == explo_internal) {
+        explo_flush();
+    }
+}
+
+void explo_output(char* buffer, unsigned long size) {
+    // smaller buffers could not hold a single line
+    if (buffer && size >= 16) {
+        explo_buffer = buffer;
+        explo_capacity = size;
+    } else {
+        explo_buffer = explo_internal;
+        explo_capacity = EXPLO_BUFFER_SIZE;
+    }
+    explo_length = 0;
+}
+
+unsigned long explo_output_length() { return explo_length; }
+
+static void explo_print_digits(uint64_t u, int negative) {
+    char digits[21];
+    int n = 0;
+    char* out;
+    do {
+        digits[n++] = '0' + u % 10;
+        u /= 10;
+    } while (u);
+    if (negative) {
+        digits[n++] = '-';
+    }
+    if (explo_length + n + 1 > explo_capacity) {
+        explo_flush();
+    }
+    out = explo_buffer + explo_length;
+    explo_length += n + 1;
+    while (n) {
+        *out++ = digits[--n];
+    }
+    *out = '\n';
+}
+
+static void explo_print_signed(int64_t a) { explo_print_digits(a < 0 ? 0 - (uint64_t)a : (uint64_t)a, a < 0); }
+static void explo_print_unsigned(uint64_t a) { explo_print_digits(a, 0); }
+
+void iprint(Int a) { explo_print_signed(a); }
+void bprint(Bool a) { explo_print_signed(a); }
+void print_i8(Int8 a) { explo_print_signed(a); }
+void print_i16(Int16 a) { explo_print_signed(a); }
+void print_i32(Int32 a) { explo_print_signed(a); }
+void print_i64(Int64 a) { explo_print_signed(a); }
+void print_u8(UInt8 a) { explo_print_unsigned(a); }
+void print_u16(UInt16 a) { explo_print_unsigned(a); }
+void print_u32(UInt32 a) { explo_print_unsigned(a); }
+void print_u64(UInt64 a) { explo_print_unsigned(a); }
+
+void print_f(Float a) {
+    // round trip precision, formatted like the interpreter does; nan has no sign there
+    char digits[32];
+    char* s = digits;
+    int n = snprintf(digits, sizeof(digits), "%.17g", a);
+    if (s[0] == '-' && s[1] == 'n') {
+        s++;
+        n--;
+    }
+    if (explo_length + n + 1 > explo_capacity) {
+        explo_flush();
+    }
+    memcpy(explo_buffer + explo_length, s, n);
+    explo_buffer[explo_length + n] = '\n';
+    explo_length += n + 1;
+}
+
+static void explo_fail(const char* message) {
+    explo_flush();
+    fprintf(stderr, "%s", message);
+#ifdef _WIN32
+    void exit(int const);
+    exit(-SIGABRT);
+#else
+    raise(SIGABRT);
+#endif
+}
+
+void abort() { explo_fail("abort"); }
+void explo_division_by_zero() { explo_fail("division by zero"); }
+
+Int from_f(Float a) {
+    // the conversion is undefined for nan and out of range values
+    if (!(a > -2147483649.0 && a < 2147483648.0)) {
+        explo_fail("float out of range");
+    }
+    return (Int)a;
+}
+
+// stdlib.h would clash with div and abort
+void* calloc(unsigned long count, unsigned long size);
+void free(void* ptr);
+
+typedef struct explo_block {
+    struct explo_block* next;
+} explo_block;
+
+static explo_block* explo_blocks;
+
+static void* explo_alloc(unsigned long size) {
+    // zeroed, the data follows the header
+    explo_block* block = calloc(1, sizeof(explo_block) + size);
+    if (!block) {
+        explo_fail("out of memory");
+    }
+    block->next = explo_blocks;
+    explo_blocks = block;
+    return block + 1;
+}
+
+Array array(Int length) {
+    Array a;
+    if (length < 0) {
+        explo_fail("negative array length");
+    }
+    a.length = length;
+    a.data = explo_alloc((unsigned long)length * sizeof(Int));
+    return a;
+}
+
+Int alen(Array a) { return a.length; }
+
+static void explo_check_index(Int length, Int index) {
+    if (index < 0 || index >= length) {
+        explo_fail("index out of range");
+    }
+}
+
+Int aget(Array a, Int index) {
+    explo_check_index(a.length, index);
+    return a.data[index];
+}
+
+void aset(Array a, Int index, Int value) {
+    explo_check_index(a.length, index);
+    a.data[index] = value;
+}
+
+static void explo_check_length(Array a, Array b) {
+    if (a.length != b.length) {
+        explo_fail("array length mismatch");
+    }
+}
+
+// plain loops, vectorized by gcc whatever the build profile is, like library routines
+#pragma GCC push_options
+#pragma GCC optimize("O3")
+
+void afill(Array a, Int value) {
+    Int* restrict d = a.data;
+    Int i;
+    for (i = 0; i < a.length; ++i) {
+        d[i] = value;
+    }
+}
+
+Int asum(Array a) {
+    const Int* restrict s = a.data;
+    unsigned acc = 0;
+    Int i;
+    for (i = 0; i < a.length; ++i) {
+        acc += s[i];
+    }
+    return (Int)acc;
+}
+
+void aadd(Array dst, Array a, Array b) {
+    Int* d = dst.data;
+    const Int* x = a.data;
+    const Int* y = b.data;
+    Int i;
+    explo_check_length(dst, a);
+    explo_check_length(dst, b);
+    for (i = 0; i < dst.length; ++i) {
+        d[i] = (Int)((unsigned)x[i] + (unsigned)y[i]);
+    }
+}
+
+void amul(Array dst, Array a, Array b) {
+    Int* d = dst.data;
+    const Int* x = a.data;
+    const Int* y = b.data;
+    Int i;
+    explo_check_length(dst, a);
+    explo_check_length(dst, b);
+    for (i = 0; i < dst.length; ++i) {
+        d[i] = (Int)((unsigned)x[i] * (unsigned)y[i]);
+    }
+}
+
+Int adot(Array a, Array b) {
+    const Int* restrict x = a.data;
+    const Int* restrict y = b.data;
+    unsigned acc = 0;
+    Int i;
+    explo_check_length(a, b);
+    for (i = 0; i < a.length; ++i) {
+        acc += (unsigned)x[i] * (unsigned)y[i];
+    }
+    return (Int)acc;
+}
+
+#pragma GCC pop_options
+
+Bool aeq(Array a, Array b) {
+    return a.length == b.length && memcmp(a.data, b.data, (unsigned long)a.length * sizeof(Int)) == 0;
+}
+
+Bytes bytes(Int length) {
+    Bytes b;
+    if (length < 0) {
+        explo_fail("negative bytes length");
+    }
+    b.length = length;
+    b.data = explo_alloc((unsigned long)length);
+    return b;
+}
+
+ByteSlice bview(Bytes b) {
+    ByteSlice s;
+    s.length = b.length;
+    s.data = b.data;
+    return s;
+}
+
+ByteSlice bslice(ByteSlice s, Int lo, Int hi) {
+    if (lo < 0 || lo > hi || hi > s.length) {
+        explo_fail("slice out of range");
+    }
+    s.length = hi - lo;
+    s.data += lo;
+    return s;
+}
+
+Int blen(ByteSlice s) { return s.length; }
+
+Int bget(ByteSlice s, Int index) {
+    explo_check_index(s.length, index);
+    return s.data[index];
+}
+
+void bset(ByteSlice s, Int index, Int value) {
+    explo_check_index(s.length, index);
+    s.data[index] = (unsigned char)value;
+}
+
+void bfill(ByteSlice s, Int value) {
+    memset(s.data, (unsigned char)value, (unsigned long)s.length);
+}
+
+Int bcompare(ByteSlice a, ByteSlice b) {
+    int res = memcmp(a.data, b.data, (unsigned long)(a.length < b.length ? a.length : b.length));
+    if (res == 0) {
+        res = a.length - b.length;
+    }
+    return (res > 0) - (res < 0);
+}
+
+Int bfind(ByteSlice s, ByteSlice needle) {
+    const unsigned char* p = s.data;
+    const unsigned char* last;
+    if (needle.length == 0) {
+        return 0;
+    }
+    if (needle.length > s.length) {
+        return -1;
+    }
+    last = s.data + (s.length - needle.length);
+    // memchr skips to candidates for the first byte
+    while (p <= last && (p = memchr(p, needle.data[0], (unsigned long)(last - p) + 1))) {
+        if (memcmp(p, needle.data, (unsigned long)needle.length) == 0) {
+            return (Int)(p - s.data);
+        }
+        ++p;
+    }
+    return -1;
+}
+
+void bwrite(ByteSlice dst, ByteSlice src) {
+    if (src.length > dst.length) {
+        explo_fail("slice too short");
+    }
+    // slices of one buffer may overlap
+    memmove(dst.data, src.data, (unsigned long)src.length);
+}
+
+static unsigned long long explo_clock() {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+unsigned long long explo_enter(explo_probe* probe) {
+    ++probe->count;
+    // recursive calls run within the outermost one, only that one is timed
+    return probe->depth++ ? 0 : explo_clock();
+}
+
+void explo_leave(explo_probe* probe, unsigned long long start) {
+    if (--probe->depth == 0) {
+        probe->nanoseconds += explo_clock() - start;
+    }
+}
+
+// stdlib.h would clash with div and abort
+char* getenv(const char* name);
+
+void explo_dump(explo_probe** probes, int count) {
+    // appended, every linked module and every run adds its own records
+    const char* path = getenv("EXPLO_PROFILE");
+    FILE* f = fopen(path ? path : "explo.profile", "a");
+    int i;
+    if (!f) {
+        return;
+    }
+    for (i = 0; i < count; ++i) {
+        fprintf(f, "%s\t%s\t%s\t%d\t%llu\t%llu\n", probes[i]->kind, probes[i]->module, probes[i]->name,
+                probes[i]->line, probes[i]->count, probes[i]->nanoseconds);
+    }
+    fclose(f);
+}
+
+#ifdef EXPLO_SHARED
+// in-process entry point, fatal signals return to the caller instead of killing the host
+#include <setjmp.h>
+
+int main();
+static sigjmp_buf explo_exit;
+static const int explo_signals[] = { SIGABRT, SIGFPE };
+#define EXPLO_SIGNALS (sizeof(explo_signals) / sizeof(explo_signals[0]))
+
+static void explo_signal(int sig) { siglongjmp(explo_exit, sig); }
+
+static void explo_release() {
+    while (explo_blocks) {
+        explo_block* next = explo_blocks->next;
+        free(explo_blocks);
+        explo_blocks = next;
+    }
+}
+
+int explo_run(int* status) {
+    struct sigaction action, saved[EXPLO_SIGNALS];
+    unsigned i;
+    int sig;
+    action.sa_handler = explo_signal;
+    sigemptyset(&action.sa_mask);
+    action.sa_flags = SA_NODEFER;
+    for (i = 0; i < EXPLO_SIGNALS; ++i) {
+        sigaction(explo_signals[i], &action, &saved[i]);
+    }
+    sig = sigsetjmp(explo_exit, 1);
+    if (sig == 0) {
+        *status = main();
+    }
+    explo_flush_internal();
+    explo_release();
+    for (i = 0; i < EXPLO_SIGNALS; ++i) {
+        sigaction(explo_signals[i], &saved[i], 0);
+    }
+    return sig;
+}
+#endif
@@ -1,41 +1,159 @@
-#include <stdio.h> // printf
-#include <signal.h>
+#include <stdint.h>
 
 typedef int Int;
-typedef int Bool;
+typedef _Bool Bool;
 typedef int Unit;
 #define false 0
 #define true 1
 #define unit 0
 
-Bool and(Bool a, Bool b) { return a && b; }
-Bool or(Bool a, Bool b) { return a || b; }
-Bool xor(Bool a, Bool b) { return a != b; }
-Bool not(Bool a) { return !a; }
-Bool beq(Bool a, Bool b) { return a == b; }
-Bool bneq(Bool a, Bool b) { return a != b; }
-
-Int add(Int a, Int b) { return a + b; }
-Int sub(Int a, Int b) { return a - b; }
-Int mul(Int a, Int b) { return a * b; }
-Int div(Int a, Int b) { return a / b; }
-Int mod(Int a, Int b) { return a % b; }
-Bool ieq(Int a, Int b) { return a == b; }
-Bool ineq(Int a, Int b) { return a != b; }
-
-Bool gt(Int a, Int b) { return a > b; }
-Bool geq(Int a, Int b) { return a >= b; }
-Bool lt(Int a, Int b) { return a < b; }
-Bool leq(Int a, Int b) { return a <= b; }
-
-void iprint(Int a) { printf("%d\n", a); }
-void bprint(Bool a) { printf("%d\n", a); }
-void abort() {
-    fprintf(stderr, "abort");
-#ifdef _WIN32
-    void exit(int const);
-    exit(-SIGABRT);
-#else
-    raise(SIGABRT);
-#endif
-}
+Bool and(Bool a, Bool b);
+Bool or(Bool a, Bool b);
+Bool xor(Bool a, Bool b);
+Bool not(Bool a);
+Bool beq(Bool a, Bool b);
+Bool bneq(Bool a, Bool b);
+
+Int add(Int a, Int b);
+Int sub(Int a, Int b);
+Int mul(Int a, Int b);
+Int div(Int a, Int b);
+Int mod(Int a, Int b);
+void explo_division_by_zero();
+Bool ieq(Int a, Int b);
+Bool ineq(Int a, Int b);
+
+Bool gt(Int a, Int b);
+Bool geq(Int a, Int b);
+Bool lt(Int a, Int b);
+Bool leq(Int a, Int b);
+Int min(Int a, Int b);
+Int max(Int a, Int b);
+
+typedef int8_t Int8;
+typedef int16_t Int16;
+typedef int32_t Int32;
+typedef int64_t Int64;
+typedef uint8_t UInt8;
+typedef uint16_t UInt16;
+typedef uint32_t UInt32;
+typedef uint64_t UInt64;
+
+// sized integers wrap around, sums and products are computed in an unsigned type at least as wide as int,
+// a quotient by -1 too; division by zero fails like in the interpreter;
+// inline so every build profile gets them as plain operators
+#define EXPLO_INTEGER(T, U, S) \
+    static inline T add_##S(T a, T b) { return (T)((U)a + (U)b); } \
+    static inline T sub_##S(T a, T b) { return (T)((U)a - (U)b); } \
+    static inline T mul_##S(T a, T b) { return (T)((U)a * (U)b); } \
+    static inline T div_##S(T a, T b) { \
+        if (b == 0) explo_division_by_zero(); \
+        return (T)((T)-1 < 0 && b == (T)-1 ? 0 - (U)a : a / b); } \
+    static inline T mod_##S(T a, T b) { \
+        if (b == 0) explo_division_by_zero(); \
+        return (T)((T)-1 < 0 && b == (T)-1 ? 0 : a % b); } \
+    static inline Bool eq_##S(T a, T b) { return a == b; } \
+    static inline Bool neq_##S(T a, T b) { return a != b; } \
+    static inline Bool gt_##S(T a, T b) { return a > b; } \
+    static inline Bool geq_##S(T a, T b) { return a >= b; } \
+    static inline Bool lt_##S(T a, T b) { return a < b; } \
+    static inline Bool leq_##S(T a, T b) { return a <= b; } \
+    static inline T to_##S(Int a) { return (T)a; } \
+    static inline Int from_##S(T a) { return (Int)a; } \
+    void print_##S(T a);
+
+EXPLO_INTEGER(Int8, unsigned, i8)
+EXPLO_INTEGER(Int16, unsigned, i16)
+EXPLO_INTEGER(Int32, unsigned, i32)
+EXPLO_INTEGER(Int64, uint64_t, i64)
+EXPLO_INTEGER(UInt8, unsigned, u8)
+EXPLO_INTEGER(UInt16, unsigned, u16)
+EXPLO_INTEGER(UInt32, unsigned, u32)
+EXPLO_INTEGER(UInt64, uint64_t, u64)
+
+void iprint(Int a);
+void bprint(Bool a);
+void abort();
+
+// inline like the sized integers, so the arithmetic is compiled with the program and its fast-math flags
+typedef double Float;
+
+static inline Float add_f(Float a, Float b) { return a + b; }
+static inline Float sub_f(Float a, Float b) { return a - b; }
+static inline Float mul_f(Float a, Float b) { return a * b; }
+static inline Float div_f(Float a, Float b) { return a / b; }
+static inline Float abs_f(Float a) { return __builtin_fabs(a); }
+static inline Float min_f(Float a, Float b) { return b < a ? b : a; }
+static inline Float max_f(Float a, Float b) { return b > a ? b : a; }
+static inline Bool eq_f(Float a, Float b) { return a == b; }
+static inline Bool neq_f(Float a, Float b) { return a != b; }
+static inline Bool gt_f(Float a, Float b) { return a > b; }
+static inline Bool geq_f(Float a, Float b) { return a >= b; }
+static inline Bool lt_f(Float a, Float b) { return a < b; }
+static inline Bool leq_f(Float a, Float b) { return a <= b; }
+static inline Float to_f(Int a) { return (Float)a; }
+Int from_f(Float a);
+void print_f(Float a);
+
+// contiguous Int elements, passed by value, the elements are shared;
+// storage lives until exit, or until the end of the run for in-process programs
+typedef struct {
+    Int length;
+    Int* data;
+} Array;
+
+Array array(Int length);
+Int alen(Array a);
+Int aget(Array a, Int index);
+void aset(Array a, Int index, Int value);
+void afill(Array a, Int value);
+Int asum(Array a);
+void aadd(Array dst, Array a, Array b);
+void amul(Array dst, Array a, Array b);
+Int adot(Array a, Array b);
+Bool aeq(Array a, Array b);
+
+// bytes are allocated like arrays, slices point into them and are never copied
+typedef struct {
+    Int length;
+    unsigned char* data;
+} Bytes;
+
+typedef struct {
+    Int length;
+    unsigned char* data;
+} ByteSlice;
+
+Bytes bytes(Int length);
+ByteSlice bview(Bytes b);
+ByteSlice bslice(ByteSlice s, Int lo, Int hi);
+Int blen(ByteSlice s);
+Int bget(ByteSlice s, Int index);
+void bset(ByteSlice s, Int index, Int value);
+void bfill(ByteSlice s, Int value);
+Int bcompare(ByteSlice a, ByteSlice b);
+Int bfind(ByteSlice s, ByteSlice needle);
+void bwrite(ByteSlice dst, ByteSlice src);
+
+// prints are collected in one buffer, written to stdout when it is full, at exit and on abort
+#define EXPLO_BUFFER_SIZE 65536
+void explo_flush();
+// a buffer of the caller replaces the internal one and drops pending output, a null buffer restores it;
+// the caller reads what is left in it after the run
+void explo_output(char* buffer, unsigned long size);
+unsigned long explo_output_length();
+
+// instrumented builds count calls and loop iterations per source location
+typedef struct {
+    const char* kind;
+    const char* module;
+    const char* name;
+    int line;
+    unsigned long long count;
+    unsigned long long nanoseconds;
+    int depth;
+} explo_probe;
+
+unsigned long long explo_enter(explo_probe* probe);
+void explo_leave(explo_probe* probe, unsigned long long start);
+void explo_dump(explo_probe** probes, int count);
@@ -1,4 +1,8 @@
 import sys
+import math
+import array
+import operator
+import itertools
 import ast
 import model
 import error
@@ -15,10 +19,40 @@ class BuiltinType(model.Builtin):
     def execute(self, context):
         return self
 
+class IntegerType(BuiltinType):
+    # fixed size, arithmetic wraps around like the C runtime does
+    def __init__(self, name, suffix, bits, signed):
+        BuiltinType.__init__(self, name)
+        self.suffix = suffix
+        self.bits = bits
+        self.signed = signed
+
+    def wrap(self, value):
+        value &= (1 << self.bits) - 1
+        if self.signed and value >> (self.bits - 1):
+            value -= 1 << self.bits
+        return value
+
+# name, builtin suffix, bits, signed
+SIZED_INTEGERS = [
+    ('Int8', 'i8', 8, True),
+    ('Int16', 'i16', 16, True),
+    ('Int32', 'i32', 32, True),
+    ('Int64', 'i64', 64, True),
+    ('UInt8', 'u8', 8, False),
+    ('UInt16', 'u16', 16, False),
+    ('UInt32', 'u32', 32, False),
+    ('UInt64', 'u64', 64, False),
+]
+
 class BuiltinFunction(model.Builtin):
-    def __init__(self, name, arg_types, return_type, impl, compile_time, context):
+    def __init__(self, name, arg_types, return_type, impl, compile_time, context, partial=False,
+                 parallel_safe=False):
         model.Builtin.__init__(self)
         self.name = name
+        self.partial = partial
+        # runtime only, but may be called from independent parallel iterations
+        self.parallel_safe = parallel_safe
         
         arg_types = [context.resolve_type(ast.Term(at)) for at in arg_types]
         if return_type:
@@ -44,23 +78,162 @@ class BuiltinFunction(model.Builtin):
     def __str__(self):
         return 'BuiltinFunction[%s](%s)' % (len(self.call_runtime_depends), self.name)
 
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+class OutputBuffer(object):
+    # prints are written in bulk: when the buffer is full, when the program exits or aborts
+    # and around calls into other modules; a bytearray given as the stream receives the output itself
+    def __init__(self, stream=sys.stdout, size=OUTPUT_BUFFER_SIZE):
+        self.stream = stream
+        self.size = size
+        self.data = stream if isinstance(stream, bytearray) else bytearray()
+
+    def write(self, s):
+        self.data += s
+        if len(self.data) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.data and self.data is not self.stream:
+            self.stream.write(str(self.data))
+            del self.data[:]
+
+def int_div(a, b):
+    # truncates towards zero like C, python rounds down
+    if b == 0:
+        raise error.InterpreterError('division by zero')
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def int_mod(a, b):
+    return a - b * int_div(a, b)
+
+def float_div(a, b):
+    # IEEE division like C, python raises on zero
+    if b == 0:
+        if a != a or a == 0:
+            return float('nan')
+        return math.copysign(float('inf'), a) * math.copysign(1.0, b)
+    return a / b
+
+def float_to_int(a):
+    # C leaves the conversion undefined out of the Int range
+    if a != a or not -2 ** 31 - 1 < a < 2 ** 31:
+        raise error.InterpreterError('float out of range')
+    return int(a)
+
+# Int elements stored like the C runtime does, bulk builtins run as one operation on the whole array
+ARRAY_TYPECODE = 'i'
+
+def new_array(length):
+    if length < 0:
+        raise error.InterpreterError('negative array length')
+    return array.array(ARRAY_TYPECODE, [0]) * length
+
+def check_index(a, index):
+    if not 0 <= index < len(a):
+        raise error.InterpreterError('index out of range')
+
+def check_length(*arrays):
+    if len(set(map(len, arrays))) > 1:
+        raise error.InterpreterError('array length mismatch')
+
+def wrap_int(value):
+    # C Int arithmetic of the runtime wraps around
+    return (value + 2 ** 31) % 2 ** 32 - 2 ** 31
+
+def array_get(a, index):
+    check_index(a, index)
+    return a[index]
+
+def array_set(a, index, value):
+    check_index(a, index)
+    a[index] = wrap_int(value)
+
+def array_fill(a, value):
+    a[:] = array.array(ARRAY_TYPECODE, [wrap_int(value)]) * len(a)
+
+def array_map(op, dst, a, b):
+    check_length(dst, a, b)
+    try:
+        dst[:] = array.array(ARRAY_TYPECODE, itertools.imap(op, a, b))
+    except OverflowError:
+        dst[:] = array.array(ARRAY_TYPECODE, itertools.imap(wrap_int, itertools.imap(op, a, b)))
+
+def array_dot(a, b):
+    check_length(a, b)
+    return wrap_int(sum(itertools.imap(operator.mul, a, b)))
+
+def new_bytes(length):
+    if length < 0:
+        raise error.InterpreterError('negative bytes length')
+    return bytearray(length)
+
+class ByteSlice(object):
+    # a range of a bytearray, slicing shares the bytearray; python 2 memoryviews can't
+    # compare or search without copying, buffers over the range can
+    __slots__ = ('data', 'start', 'stop')
+
+    def __init__(self, data, start, stop):
+        self.data = data
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def buffer(self):
+        return buffer(self.data, self.start, self.stop - self.start)
+
+def bytes_slice(s, lo, hi):
+    if not 0 <= lo <= hi <= len(s):
+        raise error.InterpreterError('slice out of range')
+    return ByteSlice(s.data, s.start + lo, s.start + hi)
+
+def bytes_get(s, index):
+    check_index(s, index)
+    return s.data[s.start + index]
+
+def bytes_set(s, index, value):
+    check_index(s, index)
+    s.data[s.start + index] = value & 0xff
+
+def bytes_fill(s, value):
+    s.data[s.start:s.stop] = chr(value & 0xff) * len(s)
+
+def bytes_compare(a, b):
+    return cmp(a.buffer(), b.buffer())
+
+def bytes_find(s, needle):
+    index = s.data.find(needle.buffer(), s.start, s.stop)
+    return index - s.start if index >= 0 else -1
+
+def bytes_write(dst, src):
+    if len(src) > len(dst):
+        raise error.InterpreterError('slice too short')
+    # bytearray assignment copies with memcpy, slices of one buffer may overlap
+    data = src.data[src.start:src.stop] if src.data is dst.data else src.buffer()
+    dst.data[dst.start:dst.start + len(src)] = data
+
 class Builtins(model.Context):
     def __init__(self, stdout=sys.stdout):
         model.Context.__init__(self, None)
+        self.output = output = OutputBuffer(stdout)
 
         self.add_term('Unit', BuiltinType('Unit'), None)
         self.add_term('Void', BuiltinType('Void'), None)
 
         def abort(*args):
+            output.flush()
             raise error.InterpreterError('abort')
-        self.add_function('abort', [], 'Void', abort, False)
+        self.add_function('abort', [], 'Void', abort, False, parallel_safe=True)
 
         bool_type = BuiltinType('Bool')
         self.add_term('Bool', bool_type, None)
         self.add_term('true', model.Value(True, bool_type, None), None)
         self.add_term('false', model.Value(False, bool_type, None), None)
         
-        self.add_function('bprint', ['Bool'], None, lambda x, args: stdout.write(str(args[0]) + '\n'), False)
+        self.add_function('bprint', ['Bool'], None, lambda x, args: output.write('%d\n' % args[0]), False)
         self.add_function('and', ['Bool', 'Bool'], 'Bool', lambda x, args: args[0] and args[1])
         self.add_function('or', ['Bool', 'Bool'], 'Bool', lambda x, args: args[0] or args[1])
         self.add_function('xor', ['Bool', 'Bool'], 'Bool', lambda x, args: args[0] != args[1])
@@ -70,19 +243,100 @@ class Builtins(model.Context):
 
         self.add_term('Int', BuiltinType('Int'), None)
         
-        self.add_function('iprint', ['Int'], None, lambda x, args: stdout.write(str(args[0]) + '\n'), False)
+        self.add_function('iprint', ['Int'], None, lambda x, args: output.write('%d\n' % args[0]), False)
         self.add_function('add', ['Int', 'Int'], 'Int', lambda x, args: args[0] + args[1])
         self.add_function('sub', ['Int', 'Int'], 'Int', lambda x, args: args[0] - args[1])
         self.add_function('mul', ['Int', 'Int'], 'Int', lambda x, args: args[0] * args[1])
-        self.add_function('div', ['Int', 'Int'], 'Int', lambda x, args: args[0] / args[1])
-        self.add_function('mod', ['Int', 'Int'], 'Int', lambda x, args: args[0] % args[1])
+        self.add_function('div', ['Int', 'Int'], 'Int', lambda x, args: wrap_int(int_div(*args)), partial=True)
+        self.add_function('mod', ['Int', 'Int'], 'Int', lambda x, args: wrap_int(int_mod(*args)), partial=True)
         self.add_function('ieq', ['Int', 'Int'], 'Bool', lambda x, args: args[0] == args[1])
         self.add_function('ineq', ['Int', 'Int'], 'Bool', lambda x, args: args[0] != args[1])
         self.add_function('gt', ['Int', 'Int'], 'Bool', lambda x, args: args[0] > args[1])
         self.add_function('geq', ['Int', 'Int'], 'Bool', lambda x, args: args[0] >= args[1])
         self.add_function('lt', ['Int', 'Int'], 'Bool', lambda x, args: args[0] < args[1])
         self.add_function('leq', ['Int', 'Int'], 'Bool', lambda x, args: args[0] <= args[1])
+        self.add_function('min', ['Int', 'Int'], 'Int', lambda x, args: min(args))
+        self.add_function('max', ['Int', 'Int'], 'Int', lambda x, args: max(args))
+
+        for name, suffix, bits, signed in SIZED_INTEGERS:
+            self.add_integer_type(IntegerType(name, suffix, bits, signed), output)
+
+        # C doubles, python floats are the same IEEE values
+        self.add_term('Float', BuiltinType('Float'), None)
+        self.add_function('add_f', ['Float', 'Float'], 'Float', lambda x, args: args[0] + args[1])
+        self.add_function('sub_f', ['Float', 'Float'], 'Float', lambda x, args: args[0] - args[1])
+        self.add_function('mul_f', ['Float', 'Float'], 'Float', lambda x, args: args[0] * args[1])
+        self.add_function('div_f', ['Float', 'Float'], 'Float', lambda x, args: float_div(*args))
+        self.add_function('abs_f', ['Float'], 'Float', lambda x, args: abs(args[0]))
+        self.add_function('min_f', ['Float', 'Float'], 'Float', lambda x, args: min(args))
+        self.add_function('max_f', ['Float', 'Float'], 'Float', lambda x, args: max(args))
+        self.add_function('eq_f', ['Float', 'Float'], 'Bool', lambda x, args: args[0] == args[1])
+        self.add_function('neq_f', ['Float', 'Float'], 'Bool', lambda x, args: args[0] != args[1])
+        self.add_function('gt_f', ['Float', 'Float'], 'Bool', lambda x, args: args[0] > args[1])
+        self.add_function('geq_f', ['Float', 'Float'], 'Bool', lambda x, args: args[0] >= args[1])
+        self.add_function('lt_f', ['Float', 'Float'], 'Bool', lambda x, args: args[0] < args[1])
+        self.add_function('leq_f', ['Float', 'Float'], 'Bool', lambda x, args: args[0] <= args[1])
+        self.add_function('to_f', ['Int'], 'Float', lambda x, args: float(args[0]))
+        self.add_function('from_f', ['Float'], 'Int', lambda x, args: float_to_int(args[0]), partial=True)
+        self.add_function('print_f', ['Float'], None, lambda x, args: output.write('%.17g\n' % args[0]), False)
+
+        # arrays are mutable, none of their builtins is evaluated at compile time;
+        # reading ones may run in parallel iterations, those can't write
+        self.add_term('Array', BuiltinType('Array'), None)
+        self.add_function('array', ['Int'], 'Array', lambda x, args: new_array(*args), False)
+        self.add_function('alen', ['Array'], 'Int', lambda x, args: len(args[0]), False, parallel_safe=True)
+        self.add_function('aget', ['Array', 'Int'], 'Int', lambda x, args: array_get(*args), False,
+                          parallel_safe=True)
+        self.add_function('aset', ['Array', 'Int', 'Int'], None, lambda x, args: array_set(*args), False)
+        self.add_function('afill', ['Array', 'Int'], None, lambda x, args: array_fill(*args), False)
+        self.add_function('asum', ['Array'], 'Int', lambda x, args: wrap_int(sum(args[0])), False, parallel_safe=True)
+        self.add_function('aadd', ['Array', 'Array', 'Array'], None,
+                          lambda x, args: array_map(operator.add, *args), False)
+        self.add_function('amul', ['Array', 'Array', 'Array'], None,
+                          lambda x, args: array_map(operator.mul, *args), False)
+        self.add_function('adot', ['Array', 'Array'], 'Int', lambda x, args: array_dot(*args), False,
+                          parallel_safe=True)
+        self.add_function('aeq', ['Array', 'Array'], 'Bool', lambda x, args: args[0] == args[1], False,
+                          parallel_safe=True)
+
+        # Bytes owns zeroed storage, ByteSlice views a range of it; elements are Ints from 0 to 255
+        self.add_term('Bytes', BuiltinType('Bytes'), None)
+        self.add_term('ByteSlice', BuiltinType('ByteSlice'), None)
+        self.add_function('bytes', ['Int'], 'Bytes', lambda x, args: new_bytes(*args), False)
+        self.add_function('bview', ['Bytes'], 'ByteSlice', lambda x, args: ByteSlice(args[0], 0, len(args[0])),
+                          False, parallel_safe=True)
+        self.add_function('bslice', ['ByteSlice', 'Int', 'Int'], 'ByteSlice', lambda x, args: bytes_slice(*args),
+                          False, parallel_safe=True)
+        self.add_function('blen', ['ByteSlice'], 'Int', lambda x, args: len(args[0]), False, parallel_safe=True)
+        self.add_function('bget', ['ByteSlice', 'Int'], 'Int', lambda x, args: bytes_get(*args), False,
+                          parallel_safe=True)
+        self.add_function('bset', ['ByteSlice', 'Int', 'Int'], None, lambda x, args: bytes_set(*args), False)
+        self.add_function('bfill', ['ByteSlice', 'Int'], None, lambda x, args: bytes_fill(*args), False)
+        self.add_function('bcompare', ['ByteSlice', 'ByteSlice'], 'Int', lambda x, args: bytes_compare(*args),
+                          False, parallel_safe=True)
+        self.add_function('bfind', ['ByteSlice', 'ByteSlice'], 'Int', lambda x, args: bytes_find(*args), False,
+                          parallel_safe=True)
+        self.add_function('bwrite', ['ByteSlice', 'ByteSlice'], None, lambda x, args: bytes_write(*args), False)
+
+    def add_integer_type(self, itype, output):
+        name, suffix, wrap = itype.name, itype.suffix, itype.wrap
+        self.add_term(name, itype, None)
+        binary = lambda op: lambda x, args: wrap(op(*args))
+        self.add_function('add_' + suffix, [name, name], name, binary(operator.add))
+        self.add_function('sub_' + suffix, [name, name], name, binary(operator.sub))
+        self.add_function('mul_' + suffix, [name, name], name, binary(operator.mul))
+        self.add_function('div_' + suffix, [name, name], name, binary(int_div), partial=True)
+        self.add_function('mod_' + suffix, [name, name], name, binary(int_mod), partial=True)
+        self.add_function('eq_' + suffix, [name, name], 'Bool', lambda x, args: args[0] == args[1])
+        self.add_function('neq_' + suffix, [name, name], 'Bool', lambda x, args: args[0] != args[1])
+        self.add_function('gt_' + suffix, [name, name], 'Bool', lambda x, args: args[0] > args[1])
+        self.add_function('geq_' + suffix, [name, name], 'Bool', lambda x, args: args[0] >= args[1])
+        self.add_function('lt_' + suffix, [name, name], 'Bool', lambda x, args: args[0] < args[1])
+        self.add_function('leq_' + suffix, [name, name], 'Bool', lambda x, args: args[0] <= args[1])
+        self.add_function('to_' + suffix, ['Int'], name, lambda x, args: wrap(args[0]))
+        self.add_function('from_' + suffix, [name], 'Int', lambda x, args: wrap_int(args[0]))
+        self.add_function('print_' + suffix, [name], None, lambda x, args: output.write('%d\n' % args[0]), False)
 
-    def add_function(self, name, args, return_type, impl, compile_time=True):
-        fn = BuiltinFunction(name, args, return_type, impl, compile_time, self)
+    def add_function(self, name, args, return_type, impl, compile_time=True, partial=False, parallel_safe=False):
+        fn = BuiltinFunction(name, args, return_type, impl, compile_time, self, partial, parallel_safe)
         self.add_term(name, fn, None)
@@ -0,0 +1,235 @@
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import subprocess
+import contextlib
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+STALE_TEMP_AGE = 3600
+
+def default_dir():
+    return os.environ.get('EXPLO_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'explo')
+
+_toolchains = {}
+
+def toolchain_id(compiler):
+    # version and target, a compiler upgrade invalidates every entry
+    if compiler not in _toolchains:
+        parts = []
+        for flag in ('--version', '-dumpmachine'):
+            p = subprocess.Popen([compiler, flag], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            parts.append(out)
+        _toolchains[compiler] = '\n'.join(parts)
+    return _toolchains[compiler]
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class Hit(Exception):
+    # the source being emitted is cached, raised out of the build to stop the compiler
+    def __init__(self, path):
+        Exception.__init__(self, path)
+        self.path = path
+
+class HashingStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.stream.write(data)
+
+class BinaryCache(object):
+    # entries are immutable files named by the hash of everything that affects the binary;
+    # inserting is a hard link, so concurrent processes never see partial files
+    # and a second insert of the same key is a no-op; eviction is LRU by mtime
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE, compiler='gcc'):
+        self.path = path or default_dir()
+        self.tmp = os.path.join(self.path, 'tmp')
+        self.max_size = max_size
+        self.compiler = compiler
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.tmp):
+            try:
+                os.makedirs(self.tmp)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def key(self, source, flags, headers=()):
+        return self.digest_key(hashlib.sha256(source).hexdigest(), flags, headers)
+
+    def digest_key(self, digest, flags, headers=()):
+        # the source enters by its own hash, so it can be hashed while it is being written
+        h = hashlib.sha256()
+        parts = [toolchain_id(self.compiler), '\0'.join(flags)]
+        for header in headers:
+            with open(header, 'rb') as f:
+                parts.append(f.read())
+        parts.append(digest)
+        for part in parts:
+            h.update('%d:' % len(part))
+            h.update(part)
+        return h.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def temp_path(self, suffix=''):
+        fd, path = tempfile.mkstemp(dir=self.tmp, suffix=suffix)
+        os.close(fd)
+        return path
+
+    def link(self, entry):
+        # a private name for the entry, it keeps working if the entry is evicted meanwhile
+        path = self.temp_path()
+        _remove(path)
+        try:
+            os.link(entry, path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        os.utime(entry, None)
+        return path
+
+    def insert(self, entry, path):
+        directory = os.path.dirname(entry)
+        if not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            os.link(path, entry)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.evict()
+
+    def get(self, source, flags, build, headers=()):
+        # a private path of the binary for the source, build(dst) runs on a miss; the caller removes it
+        return self.get_digest(hashlib.sha256(source).hexdigest(), flags, build, headers)
+
+    def lookup(self, digest, flags, headers=()):
+        # a private path of the entry for what the digest names, None without building it
+        path = self.link(self.entry(self.digest_key(digest, flags, headers)))
+        if path is not None:
+            self.hits += 1
+        return path
+
+    def get_digest(self, digest, flags, build, headers=()):
+        # like get, for an input named by its digest rather than by the source itself
+        entry = self.entry(self.digest_key(digest, flags, headers))
+        path = self.link(entry)
+        if path is None:
+            self.misses += 1
+            path = self.temp_path()
+            try:
+                build(path)
+                self.insert(entry, path)
+            except:
+                _remove(path)
+                raise
+        else:
+            self.hits += 1
+        return path
+
+    def get_streamed(self, emit, flags, build, headers=()):
+        # like get, but build(emit, dst) starts compiling while emit writes the source; the key is
+        # complete with the source, on a hit the build is stopped by Hit raised from emit
+        entries = []
+        def hashing_emit(stream):
+            tee = HashingStream(stream)
+            emit(tee)
+            entry = self.entry(self.digest_key(tee.hash.hexdigest(), flags, headers))
+            path = self.link(entry)
+            if path is not None:
+                raise Hit(path)
+            entries.append(entry)
+        path = self.temp_path()
+        try:
+            build(hashing_emit, path)
+            assert entries, 'the build did not emit the whole source'
+            self.insert(entries[0], path)
+        except Hit as hit:
+            _remove(path)
+            self.hits += 1
+            return hit.path
+        except:
+            _remove(path)
+            raise
+        self.misses += 1
+        return path
+
+    @contextlib.contextmanager
+    def binary(self, source, flags, build, headers=()):
+        path = self.get(source, flags, build, headers)
+        try:
+            yield path
+        finally:
+            _remove(path)
+
+    @contextlib.contextmanager
+    def streamed_binary(self, emit, flags, build, headers=()):
+        path = self.get_streamed(emit, flags, build, headers)
+        try:
+            yield path
+        finally:
+            _remove(path)
+
+    def entries(self):
+        for name in os.listdir(self.path):
+            directory = os.path.join(self.path, name)
+            if directory == self.tmp or not os.path.isdir(directory):
+                continue
+            for key in os.listdir(directory):
+                path = os.path.join(directory, key)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            _remove(path)
+            total -= size
+        # left behind by killed processes
+        now = time.time()
+        for name in os.listdir(self.tmp):
+            path = os.path.join(self.tmp, name)
+            try:
+                if now - os.stat(path).st_mtime > STALE_TEMP_AGE:
+                    _remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, path in list(self.entries()):
+            _remove(path)
+
+def add_arguments(parser):
+    parser.add_argument('--no-cache', action='store_true', help='always run gcc')
+    parser.add_argument('--cache-dir', metavar='PATH', help='compiled binaries cache, default %s' % default_dir())
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE / (1024 * 1024), metavar='MIB',
+                        help='cache size limit')
+
+def from_args(args):
+    if args.no_cache:
+        return None
+    return BinaryCache(args.cache_dir, args.cache_size * 1024 * 1024)
@@ -3,44 +3,470 @@ import model
 import transpiler
 import tempfile
 import subprocess
+import threading
+import shutil
+import errno
+import atexit
+import contextlib
 import os
+import sys
+import cStringIO
+import collections
+import ctypes
+import _ctypes
+import multiprocessing
+import multiprocessing.pool
 import error
+import timing
+import optimizer
+import cache
+import modules
 
 if os.name == 'nt':
     EXT = '.exe'
 else:
     EXT = ''
 
-def compile(src, dst):
-    p = subprocess.Popen(['gcc' + EXT, src, '-o', dst, '-I.'], stderr=subprocess.PIPE)
-    out, err = p.communicate()
+def _binary_dir():
+    # tmpfs keeps binaries off the disk, unless it is mounted noexec
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split() for line in f]
+    except IOError:
+        return None
+    for fields in mounts:
+        if len(fields) > 3 and fields[1] == '/dev/shm' and fields[2] == 'tmpfs':
+            if 'noexec' not in fields[3].split(',') and os.access(fields[1], os.W_OK):
+                return fields[1]
+    return None
+
+BINARY_DIR = _binary_dir()
+GCC_FLAGS = ['-I.']
+HEADERS = ['builtins.h']
+RUNTIME = 'builtins.c'
+# own definitions win over libc ones with the same names (abort, div) already loaded in the host
+SHARED_FLAGS = ['-shared', '-fPIC', '-Wl,-Bsymbolic']
+SHARED_EXT = '.so'
+
+class Profile(object):
+    def __init__(self, name, flags, internal_linkage=False, pgo=False, instrument=False):
+        self.name = name
+        self.flags = flags
+        # generated definitions are static, so gcc sees every use of them
+        self.internal_linkage = internal_linkage
+        self.pgo = pgo
+        # functions and loops count calls, iterations and time, the binary appends them to $EXPLO_PROFILE
+        self.instrument = instrument
+
+    def extend(self, flags):
+        return Profile(self.name, self.flags + flags, self.internal_linkage, self.pgo, self.instrument)
+
+PROFILES = collections.OrderedDict((p.name, p) for p in (
+    Profile('default', []),
+    Profile('debug', ['-O0', '-g']),
+    Profile('release', ['-O2', '-flto'], internal_linkage=True),
+    Profile('pgo', ['-O2', '-flto'], internal_linkage=True, pgo=True),
+    Profile('instrumented', ['-O2', '-flto'], internal_linkage=True, instrument=True),
+))
+DEFAULT_PROFILE = PROFILES['default']
+# parallel loops become omp pragmas, programs without them don't need the runtime library
+OPENMP_FLAGS = ['-fopenmp']
+# opt-in, floating point results may differ from the interpreter
+FAST_MATH_FLAGS = ['-ffast-math']
+
+def uses_openmp(m):
+    # imported modules tell it in their interfaces, they are not built for it
+    if any(isinstance(n, model.Parallel) for n in model.walk(m)):
+        return True
+    return bool(m.imports) and any(m.loader.interface(name)['openmp'] for name in modules.dependencies(m))
+
+def model_profile(m, profile=DEFAULT_PROFILE):
+    # probes are plain counters, an instrumented build runs parallel loops on one thread
+    if uses_openmp(m) and not profile.instrument:
+        return profile.extend(OPENMP_FLAGS)
+    return profile
+
+def compile(emit, dst, timings=None, objects=(), flags=GCC_FLAGS, phase='gcc'):
+    # emit(stream) writes C source, gcc reads it from the pipe while it is being produced
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase(phase):
+        # -x none ends the stdin language override, objects are linked as they are
+        p = subprocess.Popen(['gcc' + EXT, '-x', 'c', '-', '-x', 'none'] + list(objects) + ['-o', dst] + flags,
+                             stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        # drained concurrently, gcc blocks on a full stderr pipe while we block on a full stdin
+        err = []
+        reader = threading.Thread(target=lambda: err.append(p.stderr.read()))
+        reader.start()
+        try:
+            try:
+                emit(p.stdin)
+            except IOError as e:
+                # gcc exited early, its errors tell why
+                if e.errno != errno.EPIPE:
+                    raise
+            finally:
+                try:
+                    p.stdin.close()
+                except IOError:
+                    pass
+        except:
+            p.kill()
+            raise
+        finally:
+            p.wait()
+            reader.join()
     if p.returncode != 0:
-        raise error.CompilerError(err)
+        raise error.CompilerError(''.join(err))
 
-def run_c(src, prefix=''):
-    fd, binary = tempfile.mkstemp(prefix=prefix + '_', suffix='_compiled' + EXT)
-    try:
+def emit_file(src):
+    def emit(stream):
+        with open(src) as f:
+            shutil.copyfileobj(f, stream)
+    return emit
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+_runtime_objects = {}
+
+def runtime_flags(profile, shared=False):
+    flags = ['-c'] + GCC_FLAGS + profile.flags
+    if shared:
+        flags += ['-fPIC', '-DEXPLO_SHARED']
+    return flags
+
+def build_runtime(dst, timings=None, profile=DEFAULT_PROFILE, shared=False):
+    compile(emit_file(RUNTIME), dst, timings, flags=runtime_flags(profile, shared), phase='runtime')
+
+@contextlib.contextmanager
+def runtime(cache=None, timings=None, profile=DEFAULT_PROFILE, shared=False):
+    # builtins are compiled once, per cache or per process, and linked into every program
+    flags = runtime_flags(profile, shared)
+    if cache is not None:
+        with open(RUNTIME) as f:
+            source = f.read()
+        build = lambda dst: build_runtime(dst, timings, profile, shared)
+        with cache.binary(source, flags, build, HEADERS) as path:
+            yield path
+        return
+    key = tuple(flags)
+    if key not in _runtime_objects:
+        fd, path = tempfile.mkstemp(prefix='builtins_', suffix='.o', dir=BINARY_DIR)
         os.close(fd)
-        compile(src, binary)
+        atexit.register(_remove, path)
+        build_runtime(path, timings, profile, shared)
+        _runtime_objects[key] = path
+    yield _runtime_objects[key]
+
+def emit_model(m, timings=None, profile=DEFAULT_PROFILE, shared=False):
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    def emit(stream):
+        with timings.phase('transpile') as phase:
+            phase.count('c_lines', transpiler.transpile_model(m, stream, profile.internal_linkage, shared,
+                                                              instrument=profile.instrument))
+    return emit
+
+def run_binary(binary, timings=None):
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase('run'):
         p = subprocess.Popen([binary], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err = p.communicate()
-        if p.returncode < 0:
-            raise error.BinaryExecutionError((p.returncode, out, err))
-        return p.returncode, out, err
+    if p.returncode < 0:
+        raise error.BinaryExecutionError((p.returncode, out, err))
+    return p.returncode, out, err
+
+_libc = ctypes.CDLL(None)
+# EXPLO_BUFFER_SIZE of the runtime
+OUTPUT_BUFFER_SIZE = 65536
+
+class SharedProgram(object):
+    # a program built with shared=True, loaded once and run in this process as often as needed
+    def __init__(self, path):
+        self.lib = ctypes.CDLL(path, ctypes.RTLD_LOCAL)
+        self.lib.explo_run.argtypes = [ctypes.POINTER(ctypes.c_int)]
+        self.lib.explo_output.argtypes = [ctypes.c_char_p, ctypes.c_ulong]
+        self.lib.explo_output_length.restype = ctypes.c_ulong
+        self.reset = self.lib['__explo_reset']
+        # prints land here, stdout only gets what didn't fit
+        self.output = ctypes.create_string_buffer(OUTPUT_BUFFER_SIZE)
+
+    def run(self, timings=None):
+        if timings is None:
+            timings = timing.NULL_TIMINGS
+        with timings.phase('run'):
+            # program output goes through the host's stdio, pending host output must not end up in it
+            sys.stdout.flush()
+            sys.stderr.flush()
+            _libc.fflush(None)
+            out = tempfile.TemporaryFile(dir=BINARY_DIR)
+            err = tempfile.TemporaryFile(dir=BINARY_DIR)
+            saved = os.dup(1), os.dup(2)
+            try:
+                os.dup2(out.fileno(), 1)
+                os.dup2(err.fileno(), 2)
+                self.reset()
+                self.lib.explo_output(self.output, len(self.output))
+                status = ctypes.c_int()
+                sig = self.lib.explo_run(ctypes.byref(status))
+                _libc.fflush(None)
+                pending = self.output.raw[:self.lib.explo_output_length()]
+            finally:
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+                os.close(saved[0])
+                os.close(saved[1])
+            out.seek(0)
+            err.seek(0)
+            out, err = out.read() + pending, err.read()
+        if sig:
+            raise error.BinaryExecutionError((-sig, out, err))
+        return status.value, out, err
+
+    def close(self):
+        if self.lib:
+            _ctypes.dlclose(self.lib._handle)
+            self.lib = self.reset = self.output = None
+
+def train_binary(binary):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([binary], stdout=devnull, stderr=devnull)
+
+def train_shared(path):
+    # profile data is written when the library is unloaded
+    program = SharedProgram(path)
+    try:
+        program.run()
+    except error.BinaryExecutionError:
+        pass
     finally:
-        if os.path.exists(binary):
-            os.remove(binary)
+        program.close()
+
+def build(emit, dst, timings=None, profile=DEFAULT_PROFILE, cache=None, train=None, shared=False):
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    timings.info['profile'] = profile.name
+    flags = GCC_FLAGS + profile.flags
+    if shared:
+        flags = flags + SHARED_FLAGS
+    if train is None:
+        train = train_shared if shared else train_binary
+    with runtime(cache, timings, profile, shared) as obj:
+        if not profile.pgo:
+            compile(emit, dst, timings, [obj], flags)
+            return
+        # both stages compile the same source into the same dst, gcc names profile data after it
+        buf = cStringIO.StringIO()
+        emit(buf)
+        source = buf.getvalue()
+        emit = lambda stream: stream.write(source)
+        data = tempfile.mkdtemp(prefix='pgo_', dir=BINARY_DIR)
+        try:
+            compile(emit, dst, timings, [obj], flags + ['-fprofile-generate=' + data], phase='gcc:instrumented')
+            with timings.phase('pgo:train'):
+                train(dst)
+            # a training run that aborted leaves no profile, gcc then optimizes without it
+            compile(emit, dst, timings, [obj], flags + ['-fprofile-use=' + data, '-Wno-missing-profile'])
+        finally:
+            shutil.rmtree(data, ignore_errors=True)
+
+def link(objects, dst, timings=None, flags=GCC_FLAGS):
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase('link'):
+        p = subprocess.Popen(['gcc' + EXT] + list(objects) + ['-o', dst] + flags, stderr=subprocess.PIPE)
+        _, err = p.communicate()
+    if p.returncode != 0:
+        raise error.CompilerError(err)
+
+def object_flags(profile=DEFAULT_PROFILE, shared=False):
+    flags = ['-c'] + GCC_FLAGS + profile.flags
+    if shared:
+        flags += ['-fPIC']
+    return flags
 
-def run_model(m, prefix=''):
-    transpiled = transpiler.transpile_model(m)
-    fd, cpath = tempfile.mkstemp(prefix=prefix + '_', suffix='_transpiled.c')
+# C source of a module, or only the cached object of a module that did not change;
+# digest names the module in the cache without its source
+Unit = collections.namedtuple('Unit', 'name source digest object')
+
+def module_flags(profile=DEFAULT_PROFILE, shared=False):
+    # the C source of a module depends on the profile, not only on its gcc flags
+    return object_flags(profile, shared) + ['profile=' + profile.name]
+
+def module_units(m, timings=None, profile=DEFAULT_PROFILE, shared=False, cache=None):
+    # every module the program imports, then the program itself; with a cache and known
+    # optimizations a module is built only when its source or the interfaces it uses changed
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase('modules') as phase:
+        names = modules.dependencies(m)
+        phase.count('modules', len(names))
+    flags = module_flags(profile, shared)
+    units = []
+    with timings.phase('transpile') as phase:
+        for name in names:
+            digest = m.loader.object_digest(name)
+            obj = None
+            if cache is not None and digest is not None:
+                obj = cache.lookup(digest, flags, HEADERS)
+            source = None
+            if obj is None:
+                source = transpiler.transpile_model(m.loader.model(name), static=True, shared=shared,
+                                                    module=name, instrument=profile.instrument)
+            units.append(Unit(name, source, digest, obj))
+        linked = [transpiler.reset_name(name) for name in names]
+        units.append(Unit(None, transpiler.transpile_model(m, static=True, shared=shared, linked=linked,
+                                                           instrument=profile.instrument), None, None))
+        phase.count('reused', sum(1 for unit in units if unit.object is not None))
+        phase.count('c_lines', sum(unit.source.count('\n') + 1 for unit in units if unit.source is not None))
+    return units
+
+def build_modules(units, dst, timings=None, profile=DEFAULT_PROFILE, cache=None, shared=False, jobs=None):
+    # one object per module, compiled in parallel; with a cache only changed modules reach gcc
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    timings.info['profile'] = profile.name
+    if profile.pgo:
+        raise error.CompilerError('profile %s does not support programs with imports' % profile.name)
+    flags = object_flags(profile, shared)
+    workdir = tempfile.mkdtemp(prefix='modules_', dir=BINARY_DIR)
+    objects = [unit.object for unit in units]
+    built = []
+    def build_object(idx):
+        unit = units[idx]
+        if unit.object is not None:
+            return
+        def build(path):
+            built.append(unit.name)
+            compile(lambda stream: stream.write(unit.source), path, timings, flags=flags, phase='gcc:module')
+        if cache is None:
+            objects[idx] = os.path.join(workdir, '%s.o' % idx)
+            build(objects[idx])
+        elif unit.digest is not None:
+            objects[idx] = cache.get_digest(unit.digest, module_flags(profile, shared), build, HEADERS)
+        else:
+            objects[idx] = cache.get(unit.source, flags, build, HEADERS)
+    pool = multiprocessing.pool.ThreadPool(jobs or multiprocessing.cpu_count())
+    try:
+        pool.map(build_object, range(len(units)))
+        if cache is not None:
+            with timings.phase('cache') as phase:
+                phase.count('hits', len(units) - len(built))
+                phase.count('misses', len(built))
+        flags = GCC_FLAGS + profile.flags
+        if shared:
+            flags = flags + SHARED_FLAGS
+        with runtime(cache, timings, profile, shared) as obj:
+            link(objects + [obj], dst, timings, flags)
+    finally:
+        pool.close()
+        pool.join()
+        if cache is not None:
+            for path in objects:
+                if path is not None:
+                    _remove(path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_modules(units, prefix='', timings=None, cache=None, profile=DEFAULT_PROFILE, shared=False, jobs=None):
+    ext = SHARED_EXT if shared else EXT
+    fd, path = tempfile.mkstemp(prefix=prefix + '_', suffix='_compiled' + ext, dir=BINARY_DIR)
+    try:
+        os.close(fd)
+        build_modules(units, path, timings, profile, cache, shared, jobs)
+        if shared:
+            return run_shared(path, timings)
+        return run_binary(path, timings)
+    finally:
+        _remove(path)
+
+def run_emitted(emit, prefix='', timings=None, profile=DEFAULT_PROFILE):
+    fd, binary = tempfile.mkstemp(prefix=prefix + '_', suffix='_compiled' + EXT, dir=BINARY_DIR)
+    try:
+        os.close(fd)
+        build(emit, binary, timings, profile)
+        return run_binary(binary, timings)
+    finally:
+        _remove(binary)
+
+def run_c(src, prefix='', timings=None, profile=DEFAULT_PROFILE):
+    return run_emitted(emit_file(src), prefix, timings, profile)
+
+def run_shared(path, timings=None):
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase('load'):
+        program = SharedProgram(path)
     try:
-        with os.fdopen(fd, 'w') as f:
-            f.write(transpiled)
-        return run_c(cpath)
+        return program.run(timings)
     finally:
-        if os.path.exists(cpath):
-            os.remove(cpath)
+        program.close()
+
+def run_emitted_shared(emit, prefix='', timings=None, profile=DEFAULT_PROFILE):
+    fd, path = tempfile.mkstemp(prefix=prefix + '_', suffix='_compiled' + SHARED_EXT, dir=BINARY_DIR)
+    try:
+        os.close(fd)
+        build(emit, path, timings, profile, shared=True)
+        return run_shared(path, timings)
+    finally:
+        _remove(path)
+
+def transpile(m, timings=None, profile=DEFAULT_PROFILE, shared=False):
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase('transpile'):
+        tstate = transpiler.State(static=profile.internal_linkage, shared=shared, instrument=profile.instrument)
+        return transpiler.transpile_output(m, tstate)
+
+def cache_flags(profile=DEFAULT_PROFILE, shared=False):
+    flags = GCC_FLAGS + profile.flags + ['profile=' + profile.name]
+    if shared:
+        flags += SHARED_FLAGS
+    return flags
+
+def run_cached(emit, cache, timings=None, profile=DEFAULT_PROFILE, shared=False):
+    # gcc starts on the streamed source right away, the key is known once it is complete;
+    # on a hit gcc is stopped and the cached binary runs
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    hits = cache.hits
+    build_cached = lambda emit, dst: build(emit, dst, timings, profile, cache, shared=shared)
+    with cache.streamed_binary(emit, cache_flags(profile, shared), build_cached, HEADERS + [RUNTIME]) as binary:
+        with timings.phase('cache') as phase:
+            phase.count('hits' if cache.hits > hits else 'misses', 1)
+        if shared:
+            return run_shared(binary, timings)
+        return run_binary(binary, timings)
+
+def run_model(m, prefix='', timings=None, cache=None, profile=DEFAULT_PROFILE, in_process=False, jobs=None):
+    profile = model_profile(m, profile)
+    if m.imports:
+        units = module_units(m, timings, profile, in_process, cache)
+        return run_modules(units, prefix, timings, cache, profile, in_process, jobs)
+    if cache is None:
+        emit = emit_model(m, timings, profile, in_process)
+        if in_process:
+            return run_emitted_shared(emit, prefix, timings, profile)
+        return run_emitted(emit, prefix, timings, profile)
+    return run_cached(emit_model(m, timings, profile, in_process), cache, timings, profile, in_process)
+
+def add_arguments(parser):
+    parser.add_argument('--profile', choices=PROFILES.keys(), default=DEFAULT_PROFILE.name,
+                        help='gcc build profile: %s' % ', '.join(PROFILES))
+    parser.add_argument('--in-process', action='store_true',
+                        help='build a shared object and run it in this process')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                        help='modules compiled in parallel, default is the number of cpus')
+    parser.add_argument('--fast-math', action='store_true',
+                        help='let gcc reorder and approximate Float arithmetic')
+
+def profile_from_args(args):
+    profile = PROFILES[args.profile]
+    if args.fast_math:
+        return profile.extend(FAST_MATH_FLAGS)
+    return profile
 
 if __name__ == '__main__':
     import sys
@@ -52,28 +478,69 @@ if __name__ == '__main__':
     parser.add_argument('path')
     parser.add_argument('-o', '--output')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--timings', action='store_true', help='print per-phase timings to stderr')
+    parser.add_argument('--timings-json', metavar='PATH', help='write per-phase timings as json, - for stdout')
+    optimizer.add_arguments(parser)
+    cache.add_arguments(parser)
+    modules.add_arguments(parser)
+    add_arguments(parser)
     args = parser.parse_args()
     
+    timings = timing.Timings() if args.timings or args.timings_json else None
     content = open(args.path).read()
     prefix = os.path.basename(args.path)
+    profile = profile_from_args(args)
+    shared = args.in_process
 
-    m = model.build_model(content)
-    transpiled = transpiler.transpile_model(m)
+    optimize = lambda m: optimizer.optimize_from_args(m, args, timings)
+    loader = modules.loader_from_args(args.path, args, timings=timings, optimize=optimize,
+                                      variant=optimizer.variant_from_args(args))
+    m = model.build_model(content, timings=timings, loader=loader)
+    optimize(m)
+    profile = model_profile(m, profile)
+    binaries = cache.from_args(args)
+    if m.imports:
+        units = module_units(m, timings, profile, shared, binaries)
+        if args.debug:
+            for unit in units:
+                print '// module %s' % (unit.name or prefix)
+                print unit.source if unit.object is None else '// unchanged, cached object reused'
+        try:
+            if args.output:
+                # objects of unchanged modules come from the cache, the result is not cached
+                build_modules(units, args.output, timings, profile, binaries, shared, args.jobs)
+                rc = 0
+            else:
+                rc, out, err = run_modules(units, prefix, timings, binaries, profile, shared, args.jobs)
+                sys.stdout.write(out)
+                sys.stderr.write(err)
+        finally:
+            if timings:
+                timing.report(timings, sys.stderr if args.timings else None, args.timings_json)
+        sys.exit(rc)
+    if args.debug:
+        transpiled = str(transpile(m, timings, profile, shared))
+        emit = lambda stream: stream.write(transpiled)
+    else:
+        emit = emit_model(m, timings, profile, shared)
     if args.debug:
         for idx, line in enumerate(transpiled.splitlines()):
             print '%s\t%s' % (idx+1, line)
-            
-    cfd, cpath = tempfile.mkstemp(suffix='_transpiled.c', prefix=prefix + '_')
+
+    rc = 0
     try:
-        with os.fdopen(cfd, 'w') as f:
-            f.write(transpiled)
         if args.output:
-            compile(cpath, args.output)
+            build(emit, args.output, timings, profile, shared=shared)
         else:
-            rc, out, err = run_c(cpath, prefix)
+            if binaries:
+                rc, out, err = run_cached(emit, binaries, timings, profile, shared)
+            elif shared:
+                rc, out, err = run_emitted_shared(emit, prefix, timings, profile)
+            else:
+                rc, out, err = run_emitted(emit, prefix, timings, profile)
             sys.stdout.write(out)
             sys.stderr.write(err)
-            sys.exit(rc)
     finally:
-        if os.path.exists(cpath):
-            os.remove(cpath)
+        if timings:
+            timing.report(timings, sys.stderr if args.timings else None, args.timings_json)
+    sys.exit(rc)
@@ -0,0 +1,164 @@
+#!env python2.7
+import model
+import optimizer
+
+def is_pure_builtin(callee):
+    return isinstance(callee, model.Builtin) and hasattr(callee, 'call') and not callee.call_runtime_depends
+
+def constant(node):
+    node = optimizer.unwrap(node)
+    if isinstance(node, model.Value):
+        return node
+
+def same_value(a, b):
+    return type(a.value) == type(b.value) and a.value == b.value and a.type == b.type
+
+def merge(a, b):
+    return dict((k, v) for k, v in a.items() if k in b and same_value(v, b[k]))
+
+@optimizer.register
+class ConstantPropagation(optimizer.Pass):
+    name = 'constprop'
+
+    def run(self, program):
+        self.changes = 0
+        functions = [n for n in model.walk(program) if isinstance(n, model.Function)]
+        for function in functions:
+            self.tracked = optimizer.local_definitions(function)
+            self.owner = function
+            function.body = self.expression(function.body, {})
+        return self.changes
+
+    def empty(self, node):
+        return optimizer.make_block([], node.type, self.owner, node.ast_node)
+
+    def value(self, value, node):
+        self.changes += 1
+        return model.Value(value.value, value.type, node.ast_node)
+
+    def block(self, node, env):
+        statements = []
+        for idx, st in enumerate(node.statements):
+            res = self.statement(st, env)
+            if res is None:
+                if idx + 1 == len(node.statements):
+                    statements.append(self.empty(st))
+            else:
+                statements.append(res)
+        node.statements = statements
+        return node
+
+    def statement(self, node, env):
+        if isinstance(node, model.VarDef):
+            if node.value is not None:
+                node.value = self.expression(node.value, env)
+            value = constant(node.value)
+            if node in self.tracked and value is not None:
+                env[node] = value
+            else:
+                env.pop(node, None)
+            return node
+        elif isinstance(node, model.Assignment):
+            node.value = self.expression(node.value, env)
+            value = constant(node.value)
+            if node.destination in self.tracked and value is not None:
+                env[node.destination] = value
+            else:
+                env.pop(node.destination, None)
+            return node
+        elif isinstance(node, model.While):
+            for var in model.assigned(node):
+                env.pop(var, None)
+            node.condition = self.expression(node.condition, env)
+            condition = constant(node.condition)
+            if condition is not None and not condition.value:
+                self.changes += 1
+                return None
+            self.expression(node.body, dict(env))
+            return node
+        elif isinstance(node, model.Parallel):
+            # reductions are updated by every iteration, in no particular order
+            for var in model.assigned(node):
+                env.pop(var, None)
+            node.lo = self.expression(node.lo, env)
+            node.hi = self.expression(node.hi, env)
+            self.expression(node.body, dict(env))
+            return node
+        elif isinstance(node, model.If) and node.on_false is None:
+            node.condition = self.expression(node.condition, env)
+            condition = constant(node.condition)
+            if condition is not None and not condition.value:
+                self.changes += 1
+                return None
+        return self.expression(node, env)
+
+    def expression(self, node, env):
+        if isinstance(node, (model.PrecompiledExpression, model.Value, model.Builtin)):
+            return node
+        elif isinstance(node, model.Function):
+            # processed on its own, it runs in a different frame
+            return node
+        elif isinstance(node, model.VarRef):
+            if node.var_def in env:
+                return self.value(env[node.var_def], node)
+            return node
+        elif isinstance(node, model.Block):
+            return self.block(node, env)
+        elif isinstance(node, (model.VarDef, model.Assignment, model.While, model.Parallel)):
+            res = self.statement(node, env)
+            return res if res is not None else self.empty(node)
+        elif isinstance(node, model.If):
+            node.condition = self.expression(node.condition, env)
+            condition = constant(node.condition)
+            if condition is not None:
+                self.changes += 1
+                if condition.value:
+                    return self.expression(node.on_true, env)
+                elif node.on_false:
+                    return self.expression(node.on_false, env)
+                return self.empty(node)
+            on_true = dict(env)
+            self.expression(node.on_true, on_true)
+            if node.on_false:
+                on_false = dict(env)
+                self.expression(node.on_false, on_false)
+            else:
+                on_false = env
+            merged = merge(on_true, on_false)
+            env.clear()
+            env.update(merged)
+            return node
+        elif isinstance(node, model.Match):
+            node.value = self.expression(node.value, env)
+            value = constant(node.value)
+            if value is not None:
+                self.changes += 1
+                return self.expression(node.arms[node.table[value.value]], env)
+            arms = []
+            for arm in node.arms:
+                arms.append(dict(env))
+                self.expression(arm, arms[-1])
+            merged = reduce(merge, arms) if arms else {}
+            env.clear()
+            env.update(merged)
+            return node
+        if isinstance(node, model.Call) and any(node.refs):
+            # references stay variables, the callee writes them
+            node.callee = self.expression(node.callee, env)
+            node.args = [arg if ref else self.expression(arg, env) for ref, arg in zip(node.refs, node.args)]
+            for var in node.references():
+                env.pop(var, None)
+            return node
+        node.map_children(lambda child: self.expression(child, env))
+        if isinstance(node, model.Call):
+            callee = optimizer.unwrap(node.callee)
+            args = [constant(arg) for arg in node.args]
+            if is_pure_builtin(callee) and None not in args:
+                try:
+                    res = callee.call(None, args)
+                except Exception:
+                    # keep the call, it fails at runtime the same way
+                    return node
+                if res is not None:
+                    return self.value(res, node)
+        return node
@@ -0,0 +1,117 @@
+#!env python2.7
+import itertools
+import model
+import optimizer
+
+def expression_parts(statement):
+    # expressions evaluated exactly once, before anything else the statement does
+    if isinstance(statement, (model.VarDef, model.Assignment)):
+        return [statement.value] if statement.value is not None else []
+    elif isinstance(statement, model.If):
+        return [statement.condition]
+    elif isinstance(statement, model.Match):
+        return [statement.value]
+    elif isinstance(statement, model.Parallel):
+        return [statement.lo, statement.hi]
+    elif isinstance(statement, (model.While, model.Block, model.PrecompiledExpression, model.Function)):
+        return []
+    return [statement]
+
+@optimizer.register
+class CommonSubexpressions(optimizer.Pass):
+    name = 'cse'
+
+    def run(self, program):
+        self.purity = optimizer.Purity()
+        self.counter = itertools.count(1)
+        self.changes = 0
+        for function in [n for n in model.walk(program) if isinstance(n, model.Function)]:
+            self.owner = function
+            self.local = optimizer.local_definitions(function)
+            self.block(function.body)
+        return self.changes
+
+    def nested(self, node):
+        for child in node.children():
+            if isinstance(child, model.Block):
+                self.block(child)
+            elif not isinstance(child, (model.Function, model.PrecompiledExpression)):
+                self.nested(child)
+
+    def calls(self, node, res):
+        # temporaries are computed ahead of the statement, a call that can fail must not run before its siblings
+        if isinstance(node, model.Call) and node.type is not None and self.purity.expression(node, total=True):
+            key = optimizer.expression_key(node)
+            if key is not None:
+                res.append((key, node))
+        if not isinstance(node, (model.Block, model.If, model.Match, model.While, model.Parallel, model.Function,
+                                 model.PrecompiledExpression)):
+            for child in node.children():
+                self.calls(child, res)
+
+    def depends(self, node):
+        return set(n.var_def for n in model.walk(node) if isinstance(n, model.VarRef))
+
+    def block(self, block):
+        for st in block.statements:
+            self.nested(st)
+
+        # group occurrences of equal expressions while none of their variables changes
+        groups = []
+        group_of = {}
+        active = {}
+        for idx, st in enumerate(block.statements):
+            parts = expression_parts(st)
+            if not any(model.assigned(part) for part in parts):
+                found = []
+                for part in parts:
+                    self.calls(part, found)
+                for key, node in found:
+                    if key not in active:
+                        active[key] = (self.depends(node), [])
+                        groups.append(active[key][1])
+                    active[key][1].append((idx, node))
+                    group_of[id(node)] = active[key][1]
+            killed = model.assigned(st)
+            clobber = self.purity.modifies_globals(st)
+            for key, (deps, occurrences) in active.items():
+                for var in deps:
+                    if var in killed or (clobber and not var.readonly and var not in self.local):
+                        del active[key]
+                        break
+
+        # the outermost repeated expressions win, nested ones are computed once inside them
+        selected = dict((id(group), []) for group in groups)
+        def select(node, idx):
+            group = group_of.get(id(node))
+            if group is not None and len(group) > 1:
+                selected[id(group)].append((idx, node))
+            elif not isinstance(node, (model.Block, model.If, model.Match, model.While, model.Parallel,
+                                       model.Function, model.PrecompiledExpression)):
+                for child in node.children():
+                    select(child, idx)
+        for idx, st in enumerate(block.statements):
+            for part in expression_parts(st):
+                select(part, idx)
+
+        temps = {}
+        replacements = {}
+        for group in groups:
+            occurrences = selected[id(group)]
+            if len(occurrences) < 2:
+                continue
+            idx, first = occurrences[0]
+            temp = optimizer.make_var('__cse_%s' % next(self.counter), first, first.type, self.owner,
+                                      ast_node=first.ast_node)
+            temps.setdefault(idx, []).append(temp)
+            for _, node in occurrences:
+                replacements[id(node)] = temp
+            self.changes += len(occurrences) - 1
+        if not temps:
+            return
+
+        statements = []
+        for idx, st in enumerate(block.statements):
+            statements += temps.get(idx, [])
+            statements.append(optimizer.substitute(st, replacements))
+        block.statements = statements
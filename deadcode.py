@@ -0,0 +1,98 @@
+#!env python2.7
+import logging
+import model
+import optimizer
+
+logger = logging.getLogger('deadcode')
+
+def type_nodes(node):
+    if isinstance(node, (model.VarDef, model.Value, model.Construct)):
+        yield node.type
+    elif isinstance(node, model.Function):
+        yield node.return_type
+    elif isinstance(node, model.RecordType):
+        for name, ftype in node.fields:
+            yield ftype
+
+def references(node, definitions):
+    stack = [node]
+    seen = set()
+    while stack:
+        node = stack.pop()
+        if node is None or id(node) in seen:
+            continue
+        seen.add(id(node))
+        if node in definitions:
+            yield definitions[node]
+        if isinstance(node, model.VarRef):
+            yield node.var_def
+        elif isinstance(node, model.Assignment):
+            yield node.destination
+        elif isinstance(node, model.PrecompiledExpression):
+            # only the value is emitted, the expression itself was evaluated while building the model
+            stack.append(node.value)
+            stack.append(node.type)
+            continue
+        stack.extend(type_nodes(node))
+        stack.extend(node.children())
+
+def describe(var_def):
+    value = optimizer.unwrap(var_def.value)
+    if isinstance(value, model.Function):
+        return 'function'
+    elif var_def.type is model.BUILTIN_META_TYPE:
+        return 'type'
+    return 'variable'
+
+def find_reachable(program, roots):
+    top = [st for st in program.statements if isinstance(st, model.VarDef)]
+    # compile time values (functions, enums) are referenced directly, map them back to definitions
+    definitions = {}
+    for var_def in top:
+        value = optimizer.unwrap(var_def.value)
+        if isinstance(value, model.Node) and not isinstance(value, (model.Value, model.Builtin)):
+            definitions[value] = var_def
+    reachable = set()
+    stack = [var_def for var_def in top if var_def.name in roots]
+    stack += [st for st in program.statements if not isinstance(st, model.VarDef)]
+    while stack:
+        node = stack.pop()
+        if node in reachable:
+            continue
+        reachable.add(node)
+        for ref in references(node, definitions):
+            if ref not in reachable:
+                stack.append(ref)
+    return reachable
+
+@optimizer.register
+class DeadDefinitions(optimizer.Pass):
+    name = 'dead-definitions'
+
+    def __init__(self, options):
+        optimizer.Pass.__init__(self, options)
+        self.exports = set(options.get('exports') or ())
+        self.removed = []
+
+    def run(self, program):
+        roots = set(self.exports) | set(getattr(program, 'exports', ()))
+        names = set(st.name for st in program.statements if isinstance(st, model.VarDef))
+        if 'main' in names:
+            roots.add('main')
+        if not roots:
+            # a library without entry points, nothing is known to be dead
+            return 0
+        reachable = find_reachable(program, roots)
+        statements = []
+        for st in program.statements:
+            if st in reachable:
+                statements.append(st)
+            else:
+                logger.debug('removing %s %s', describe(st), st.name)
+                self.removed.append(st)
+        program.statements = statements
+        return len(self.removed)
+
+    def report(self):
+        return ['removed %s %s (line %s)' % (describe(st), st.name, st.ast_node.srcmap[0] if st.ast_node else '?')
+                for st in self.removed]
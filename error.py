@@ -16,6 +16,9 @@ class TranspilerError(CompileTimeError):
 class CompilerError(CompileTimeError):
     pass
 
+class OptimizerError(CompileTimeError):
+    pass
+
 class InterpreterError(ExecutionTimeError):
     pass
 
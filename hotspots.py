@@ -0,0 +1,102 @@
+#!env python2.7
+import os
+import sys
+import collections
+import model
+import modules
+
+DEFAULT_PATH = 'explo.profile'
+
+class Record(object):
+    def __init__(self, kind, module, name, line):
+        self.kind = kind
+        self.module = module
+        self.name = name
+        self.line = line
+        self.count = 0
+        self.nanoseconds = 0
+
+def read(path):
+    # records of the same probe are summed, the dump is appended by every run and module
+    records = collections.OrderedDict()
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 6:
+                continue
+            kind, module, name, lineno, count, nanoseconds = fields
+            key = kind, module, name, int(lineno)
+            if key not in records:
+                records[key] = Record(*key)
+            records[key].count += int(count)
+            records[key].nanoseconds += int(nanoseconds)
+    return records.values()
+
+class Sources(object):
+    # the program itself is the module without a name, the others are found like imports
+    def __init__(self, program=None, search_path=()):
+        self.program = program
+        directory = os.path.dirname(os.path.abspath(program)) if program else '.'
+        self.loader = modules.Loader([directory] + list(search_path))
+        self.lines = {}
+
+    def path(self, module):
+        if not module:
+            return self.program
+        try:
+            return self.loader.path(module)
+        except model.ModelError:
+            return None
+
+    def line(self, module, lineno):
+        path = self.path(module)
+        if path is None:
+            return ''
+        if path not in self.lines:
+            with open(path) as f:
+                self.lines[path] = f.read().splitlines()
+        lines = self.lines[path]
+        return lines[lineno - 1].strip() if 0 < lineno <= len(lines) else ''
+
+    def location(self, module, lineno):
+        path = self.path(module)
+        name = os.path.basename(path) if path else (module or '?') + modules.EXTENSION
+        return '%s:%s' % (name, lineno)
+
+def table(records, sources, limit=None, order='time'):
+    functions = [r for r in records if r.kind == 'function']
+    total = sum(r.nanoseconds for r in functions if r.name == 'main') or max([r.nanoseconds for r in functions] or [0])
+    if order == 'time':
+        key = lambda r: (r.nanoseconds, r.count)
+    else:
+        key = lambda r: (r.count, r.nanoseconds)
+    records = sorted(records, key=key, reverse=True)[:limit]
+    rows = [('time ms', '%', 'count', 'kind', 'location', 'name', 'source')]
+    for r in records:
+        timed = r.kind == 'function'
+        rows.append(('%.3f' % (r.nanoseconds / 1e6) if timed else '',
+                     '%.1f' % (100.0 * r.nanoseconds / total) if timed and total else '',
+                     str(r.count), r.kind, sources.location(r.module, r.line), r.name,
+                     sources.line(r.module, r.line)))
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(rows[0]) - 1)]
+    lines = []
+    for row in rows:
+        cells = [cell.rjust(width) if idx < 3 else cell.ljust(width)
+                 for idx, (cell, width) in enumerate(zip(row, widths))]
+        lines.append('  '.join(cells + [row[-1]]).rstrip())
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='map counters of an instrumented build back to the source')
+    parser.add_argument('profile', nargs='?', default=os.environ.get('EXPLO_PROFILE') or DEFAULT_PATH)
+    parser.add_argument('-s', '--source', metavar='PATH', help='the program the binary was built from')
+    parser.add_argument('-I', dest='module_path', action='append', default=[], metavar='DIR',
+                        help='search imported modules here after the directory of the program')
+    parser.add_argument('-n', '--limit', type=int, help='show only the hottest records')
+    parser.add_argument('--sort', choices=('time', 'count'), default='time')
+    args = parser.parse_args()
+
+    records = read(args.profile)
+    sources = Sources(args.source, args.module_path)
+    print table(records, sources, args.limit, args.sort)
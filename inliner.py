@@ -0,0 +1,148 @@
+#!env python2.7
+import copy
+import itertools
+import model
+import optimizer
+
+def clone(node, var_map, owner, fresh):
+    if isinstance(node, (model.Builtin, model.Value, model.Function)):
+        return node
+    res = copy.copy(node)
+    if isinstance(node, model.VarDef):
+        res.name = fresh(node.name)
+        res.owner = owner
+        var_map[node] = res
+    elif isinstance(node, model.VarRef):
+        res.var_def = var_map.get(node.var_def, node.var_def)
+    elif isinstance(node, model.Assignment):
+        res.destination = var_map.get(node.destination, node.destination)
+    elif isinstance(node, model.Parallel):
+        res.reductions = [(kind, var_map.get(var, var)) for kind, var in node.reductions]
+    if isinstance(getattr(node, 'runtime_depends', None), list):
+        res.runtime_depends = [var_map.get(rd, rd) for rd in node.runtime_depends]
+    res.map_children(lambda child: clone(child, var_map, owner, fresh))
+    return res
+
+def called_functions(node):
+    for n in model.walk(node):
+        if isinstance(n, model.Call):
+            callee = optimizer.unwrap(n.callee)
+            if isinstance(callee, model.Function):
+                yield callee
+
+def find_recursive(functions):
+    calls = dict((f, set(called_functions(f.body))) for f in functions)
+    res = set()
+    for f in functions:
+        seen = set()
+        stack = list(calls[f])
+        while stack:
+            g = stack.pop()
+            if g is f:
+                res.add(f)
+                break
+            if g not in seen:
+                seen.add(g)
+                stack.extend(calls.get(g, ()))
+    return res
+
+def free_variables(function):
+    local = set(n for n in model.walk(function) if isinstance(n, model.VarDef))
+    res = set()
+    for n in model.walk(function.body):
+        if isinstance(n, model.VarRef) and n.var_def not in local:
+            res.add(n.var_def)
+        elif isinstance(n, model.Assignment) and n.destination not in local:
+            res.add(n.destination)
+    return res
+
+def local_names(function):
+    return set(n.name for n in model.walk(function) if isinstance(n, model.VarDef))
+
+@optimizer.register
+class Inliner(optimizer.Pass):
+    name = 'inline'
+    budget = 30
+
+    def __init__(self, options):
+        optimizer.Pass.__init__(self, options)
+        if options.get('inline_budget') is not None:
+            self.budget = options['inline_budget']
+        self.counter = itertools.count(1)
+
+    def fresh(self, name):
+        return '__inl_%s_%s' % (name, next(self.counter))
+
+    def run(self, program):
+        functions = [n for n in model.walk(program) if isinstance(n, model.Function)]
+        self.recursive = find_recursive(functions)
+        self.candidates = {}
+        self.locals = {}
+        self.changes = 0
+        self.visit(program, None)
+        return self.changes
+
+    def candidate(self, function):
+        if function not in self.candidates:
+            ok = function not in self.recursive and optimizer.size(function.body) <= self.budget
+            # arguments become copies when inlined
+            ok = ok and not any(arg.by_ref for arg in function.args)
+            if ok:
+                ok = not any(isinstance(n, model.Function) for n in model.walk(function.body))
+            if ok:
+                free = free_variables(function)
+                ok = all(v.owner is None for v in free)
+                self.candidates[function] = ok and set(v.name for v in free)
+            else:
+                self.candidates[function] = None
+        return self.candidates[function]
+
+    def inlinable(self, call, function, statement):
+        callee = optimizer.unwrap(call.callee)
+        if function is None or not isinstance(callee, model.Function) or callee is function:
+            return None
+        # impure calls are only moved out of statements, so the evaluation order is preserved
+        if not statement and callee.call_runtime_depends:
+            return None
+        if any(arg.type is None for arg in call.args):
+            return None
+        free = self.candidate(callee)
+        if free is None or free is False:
+            return None
+        if function not in self.locals:
+            self.locals[function] = local_names(function)
+        if free & self.locals[function]:
+            return None
+        return callee
+
+    def inline(self, call, callee, function):
+        var_map = {}
+        statements = []
+        for arg_def, arg in zip(callee.args, call.args):
+            var = optimizer.make_var(self.fresh(arg_def.name), arg, arg_def.type, function, ast_node=arg_def.ast_node)
+            var_map[arg_def] = var
+            statements.append(var)
+        statements.append(clone(callee.body, var_map, function, self.fresh))
+        self.changes += 1
+        return optimizer.make_block(statements, call.type, function, call.ast_node)
+
+    def visit(self, node, function, statement=False):
+        if isinstance(node, model.PrecompiledExpression):
+            # already evaluated while building the model
+            return node
+        elif isinstance(node, model.Function):
+            node.body = self.visit(node.body, node, True)
+        elif isinstance(node, model.Block):
+            node.statements = [self.visit(st, function, True) for st in node.statements]
+        elif isinstance(node, model.While):
+            # the condition is evaluated on every iteration, it has to stay an expression
+            node.body = self.visit(node.body, function, True)
+        elif isinstance(node, (model.VarDef, model.Assignment, model.If, model.Match)):
+            node.map_children(lambda child: self.visit(child, function, statement))
+        else:
+            node.map_children(lambda child: self.visit(child, function))
+            if isinstance(node, model.Call):
+                callee = self.inlinable(node, function, statement)
+                if callee:
+                    return self.inline(node, callee, function)
+        return node
@@ -13,6 +13,12 @@ keywords = (
     'if',
     'else',
     'while',
+    'import',
+    'parallel',
+    'in',
+    'reduce',
+    'ref',
+    'match',
     )
 tokens = (
     'ID',
@@ -73,6 +79,12 @@ def lexer():
     res.errors = []
     return res
 
+def tokenize(content):
+    res = lexer()
+    res.input(content)
+    res.token_list = list(iter(res.token, None))
+    return res
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     
@@ -0,0 +1,77 @@
+#!env python2.7
+import itertools
+import model
+import optimizer
+
+def defined(node):
+    return set(n for n in model.walk(node) if isinstance(n, model.VarDef))
+
+@optimizer.register
+class LoopInvariantCodeMotion(optimizer.Pass):
+    name = 'licm'
+
+    def run(self, program):
+        self.purity = optimizer.Purity()
+        self.counter = itertools.count(1)
+        self.changes = 0
+        for function in [n for n in model.walk(program) if isinstance(n, model.Function)]:
+            self.owner = function
+            self.local = optimizer.local_definitions(function)
+            self.block(function.body)
+        return self.changes
+
+    def block(self, block):
+        statements = []
+        for st in block.statements:
+            self.nested(st)
+            if isinstance(st, model.While):
+                statements += self.hoist(st)
+            statements.append(st)
+        block.statements = statements
+
+    def nested(self, node):
+        # inner loops first, so their invariants can leave the outer loop too
+        for child in node.children():
+            if isinstance(child, model.Block):
+                self.block(child)
+            elif not isinstance(child, (model.Function, model.PrecompiledExpression)):
+                self.nested(child)
+
+    def variant(self, var_def):
+        if var_def in self.changed:
+            return True
+        return self.clobber and not var_def.readonly and var_def not in self.local
+
+    def invariant(self, call):
+        if call.type is None or optimizer.expression_key(call) is None:
+            return False
+        if not self.purity.expression(call, total=True):
+            return False
+        return not any(isinstance(n, model.VarRef) and self.variant(n.var_def) for n in model.walk(call))
+
+    def collect(self, node, res):
+        if isinstance(node, model.Call) and self.invariant(node):
+            res.append(node)
+        elif not isinstance(node, (model.Function, model.PrecompiledExpression)):
+            for child in node.children():
+                self.collect(child, res)
+
+    def hoist(self, loop):
+        self.changed = model.assigned(loop) | defined(loop)
+        self.clobber = self.purity.modifies_globals(loop)
+        candidates = []
+        self.collect(loop.condition, candidates)
+        self.collect(loop.body, candidates)
+        temps = {}
+        hoisted = []
+        replacements = {}
+        for call in candidates:
+            key = optimizer.expression_key(call)
+            if key not in temps:
+                name = '__licm_%s' % next(self.counter)
+                temps[key] = optimizer.make_var(name, call, call.type, self.owner, ast_node=call.ast_node)
+                hoisted.append(temps[key])
+            replacements[id(call)] = temps[key]
+        loop.map_children(lambda child: optimizer.substitute(child, replacements))
+        self.changes += len(candidates)
+        return hoisted
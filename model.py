@@ -1,5 +1,6 @@
 #!env python2.7
 import sys
+import multiprocessing
 import ast
 import error
 
@@ -53,9 +54,35 @@ class NotInitialized(ModelError):
         ModelError.__init__(self, 'not initialized: %s' % name, None)
 
 class Node(object):
+    child_fields = ()
+
     def __init__(self, ast_node=None):
         self.ast_node = ast_node
 
+    def children(self):
+        for field in self.child_fields:
+            value = getattr(self, field)
+            if isinstance(value, list):
+                for item in value:
+                    yield item
+            elif value is not None:
+                yield value
+
+    def map_children(self, fn):
+        for field in self.child_fields:
+            value = getattr(self, field)
+            if isinstance(value, list):
+                setattr(self, field, [fn(item) for item in value])
+            elif value is not None:
+                setattr(self, field, fn(value))
+
+def walk(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.children())
+
 class Builtin(Node):
     def __init__(self):
         self.name = None
@@ -77,6 +104,11 @@ class Expression(Node):
         #self.runtime_depends = None
         self.type = None
 
+def unwrap(node):
+    if isinstance(node, PrecompiledExpression):
+        return node.value
+    return node
+
 def is_unit_type(a):
     if isinstance(a, PrecompiledExpression):
         a = a.value
@@ -89,10 +121,17 @@ def check_assignable_from(a, b, c):
         a = a.value
     if isinstance(b, PrecompiledExpression):
         b = b.value
+    # a ref parameter takes a variable of its target type
+    if isinstance(a, RefType):
+        a = a.target
     if a != b:
         raise TypeMismatch(a, b, c)
 
 class VarDef(Node):
+    child_fields = ('value',)
+    # ref parameters hold a cell of a variable of the caller
+    by_ref = False
+
     def __init__(self, ast_node, context, is_argument=False):
         Node.__init__(self, ast_node)
         self.owner = context.owner
@@ -109,6 +148,13 @@ class VarDef(Node):
             
         if ast_node.type:
             self.type = context.resolve_type(ast_node.type)
+            if isinstance(unwrap(self.type), RefType):
+                if not is_argument:
+                    raise ModelError('references are only allowed as parameters', ast_node)
+                self.ref_type = unwrap(self.type)
+                self.type = self.ref_type.target
+                self.by_ref = True
+                self.readonly = False
             if self.value:
                 check_assignable_from(self.type, self.value.type, ast_node)
         else:
@@ -136,11 +182,67 @@ class VarRef(Expression):
             self.runtime_depends = [self.var_def]
 
     def execute(self, context):
+        if self.var_def.by_ref:
+            return context.get_value(self.var_def.name).get()
         return context.get_value(self.var_def.name)
 
     def __str__(self):
         return 'VarRef[%s](%s)' % (len(self.runtime_depends), self.var_def.name)
 
+class RefType(Node):
+    def __init__(self, ast_node, context):
+        Node.__init__(self, ast_node)
+        self.target = unwrap(context.resolve_type(ast_node.type))
+        if isinstance(self.target, RefType):
+            raise ModelError('reference to a reference', ast_node)
+        self.type = BUILTIN_META_TYPE
+        self.runtime_depends = []
+
+    def __eq__(self, other):
+        return isinstance(other, RefType) and self.target == other.target
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.target)
+
+    def __str__(self):
+        return 'ref %s' % self.target
+
+    def execute(self, context):
+        return self
+
+class Cell(object):
+    # a variable of another frame, ref parameters read and write it in place
+    __slots__ = ('context', 'name')
+
+    def __init__(self, context, name):
+        self.context = context
+        self.name = name
+
+    def get(self):
+        return self.context.get_value(self.name)
+
+    def set(self, value):
+        self.context.assign_value(self.name, value)
+
+def reference(context, var_def):
+    # ref parameters pass their own cell on
+    if var_def.by_ref:
+        return context.get_value(var_def.name)
+    return context.cell(var_def.name)
+
+def assigned(node):
+    # variables written by the node, directly or through ref parameters
+    res = set()
+    for n in walk(node):
+        if isinstance(n, Assignment):
+            res.add(n.destination)
+        elif isinstance(n, Call):
+            res.update(n.references())
+    return res
+
 class Value(Expression):
     def __init__(self, value, type, ast_node):
         Expression.__init__(self, ast_node)
@@ -163,14 +265,22 @@ class FuncType(Node):
         return 'FuncType(%s, %s)' % (map(str, self.arg_types), self.return_type)
 
 class Call(Expression):
-    def __init__(self, ast_node, context):
+    child_fields = ('callee', 'args')
+
+    def __init__(self, ast_node, context, callee):
         Expression.__init__(self, ast_node)
-        self.callee = context.create_expression(ast_node.callee)
-        self.args = [context.create_expression(arg) for arg in ast_node.args]
+        self.callee = callee
         if not isinstance(self.callee.type, FuncType):
             raise ModelError('Not callable: %s' % self.callee.type, ast_node)
-        if len(self.callee.type.arg_types) != len(self.args):
+        if len(self.callee.type.arg_types) != len(ast_node.args):
             raise ModelError('Argument count mismatch', ast_node)
+        self.refs = [isinstance(unwrap(t), RefType) for t in self.callee.type.arg_types]
+        self.args = []
+        for ref, arg in zip(self.refs, ast_node.args):
+            if ref:
+                self.args.append(self.reference(arg, context))
+            else:
+                self.args.append(context.create_expression(arg))
         for exp_type, got_arg in zip(self.callee.type.arg_types, self.args):
             check_assignable_from(exp_type, got_arg.type, ast_node)
         self.type = self.callee.type.return_type
@@ -182,25 +292,55 @@ class Call(Expression):
         if len(self.callee.runtime_depends) == 0:
             callee = self.callee.execute(context)
             self.runtime_depends += callee.call_runtime_depends
+            for var in self.references():
+                if var in callee.call_runtime_depends:
+                    raise ModelError('Variable is passed by reference and used by the callee: %s' % var.name,
+                                     ast_node)
+        # the call writes its references at runtime, later reads can't be folded
+        for var in self.references():
+            var.runtime_depends = [var]
+            if var not in self.runtime_depends:
+                self.runtime_depends.append(var)
+
+    def reference(self, ast_node, context):
+        if not isinstance(ast_node, ast.Term):
+            raise ModelError('Only variables can be passed by reference', ast_node)
+        var = context.resolve_term(ast_node.name, ast_node)
+        if not isinstance(var, VarDef) or var.readonly:
+            raise ModelError('Reference to immutable variable: %s' % ast_node.name, ast_node)
+        if var in self.references():
+            raise ModelError('Variable is passed by reference twice: %s' % ast_node.name, ast_node)
+        # never folded, the callee needs the variable itself
+        return VarRef(ast_node, var, context)
+
+    def references(self):
+        return [arg.var_def for ref, arg in zip(self.refs, self.args) if ref]
 
     def __str__(self):
         return '%s(%s)' % (self.callee, ', '.join(map(str, self.args)))
 
     def execute(self, context):
         callee = self.callee.execute(context)
-        args = [arg.execute(context) for arg in self.args]
+        if any(self.refs):
+            args = [reference(context, arg.var_def) if ref else arg.execute(context)
+                    for ref, arg in zip(self.refs, self.args)]
+        else:
+            args = [arg.execute(context) for arg in self.args]
         return callee.call(context, args)
 
 class AttributeAccess(Expression):
-    def __init__(self, ast_node, context):
+    child_fields = ('obj',)
+
+    def __init__(self, ast_node, context, obj):
         Expression.__init__(self, ast_node)
-        self.obj = context.create_expression(ast_node.obj)
+        self.obj = obj
         self.attribute = ast_node.attribute
-        if self.attribute in self.obj.type.attr_types:
+        # builtin types have no attributes at all
+        if self.attribute in getattr(self.obj.type, 'attr_types', {}):
             self.type = self.obj.type.attr_types[self.attribute]
         elif len(self.obj.runtime_depends) == 0:
             obj = self.obj.execute(context)
-            if self.attribute in obj.attr_types:
+            if self.attribute in getattr(obj, 'attr_types', {}):
                 self.type = obj.attr_types[self.attribute]
             else:
                 raise NoSuchAttribute(self.obj.type, self.attribute, ast_node)
@@ -217,6 +357,8 @@ class AttributeAccess(Expression):
         return obj.get_attr(context, self.attribute)
 
 class Assignment(Node):
+    child_fields = ('value',)
+
     def __init__(self, ast_node, context):
         Node.__init__(self, ast_node)
         self.destination = context.resolve_term(ast_node.destination, ast_node)
@@ -242,9 +384,14 @@ class Assignment(Node):
 
     def execute(self, context):
         value = self.value.execute(context)
-        context.assign_value(self.destination.name, value)
+        if self.destination.by_ref:
+            context.get_value(self.destination.name).set(value)
+        else:
+            context.assign_value(self.destination.name, value)
 
 class If(Expression):
+    child_fields = ('condition', 'on_true', 'on_false')
+
     def __init__(self, ast_node, context):
         Expression.__init__(self, ast_node)
         self.condition = context.create_expression(ast_node.condition)
@@ -273,6 +420,8 @@ class If(Expression):
             return self.on_false.execute(context)
 
 class While(Expression):
+    child_fields = ('condition', 'body')
+
     def __init__(self, ast_node, context):
         Expression.__init__(self, ast_node)
         self.context = Context(context, self)
@@ -298,30 +447,346 @@ class While(Expression):
         while self.condition.execute(context).value:
             self.body.execute(context)
 
+# reduction kind: builtin updating it, identity in the C Int range like OpenMP, combination of partial results
+REDUCTIONS = {
+    'sum': ('add', 0, lambda a, b: a + b),
+    'product': ('mul', 1, lambda a, b: a * b),
+    'min': ('min', 2 ** 31 - 1, min),
+    'max': ('max', -2 ** 31, max),
+}
+# smaller loops are not worth forking the interpreter
+PARALLEL_MIN_ITERATIONS = 4096
+PARALLEL_WORKERS = None
+
+_parallel_job = None
+_in_parallel_worker = False
+
+def _start_parallel_worker():
+    global _in_parallel_worker
+    _in_parallel_worker = True
+
+def _run_parallel_chunk(bounds):
+    node, context = _parallel_job
+    try:
+        return node.run_chunk(context, *bounds)
+    except error.InterpreterError:
+        raise
+    except Exception as e:
+        # model errors don't survive pickling back to the parent
+        raise error.InterpreterError('%s: %s' % (type(e).__name__, e))
+
+class Parallel(Expression):
+    child_fields = ('lo', 'hi', 'var', 'body')
+
+    def __init__(self, ast_node, context):
+        Expression.__init__(self, ast_node)
+        int_type = context.resolve_type(ast.Term('Int'))
+        self.lo = context.create_expression(ast_node.lo)
+        check_assignable_from(int_type, self.lo.type, ast_node)
+        self.hi = context.create_expression(ast_node.hi)
+        check_assignable_from(int_type, self.hi.type, ast_node)
+        self.reductions = []
+        for kind, name in ast_node.reductions:
+            if kind not in REDUCTIONS:
+                raise ModelError('unknown reduction: %s' % kind, ast_node)
+            var = context.resolve_term(name, ast_node)
+            if not isinstance(var, VarDef) or var.readonly:
+                raise ModelError('reduction variable is not assignable: %s' % name, ast_node)
+            if var.by_ref:
+                # each thread reduces into a copy of its own, there is none for a variable of the caller
+                raise ModelError('reduction variable is a ref parameter: %s' % name, ast_node)
+            check_assignable_from(int_type, var.type, ast_node)
+            self.reductions.append((kind, var))
+
+        root = context
+        while root.parent:
+            root = root.parent
+        self.output = root.output
+        self.context = Context(context, self)
+        self.var = VarDef(ast.Var(ast_node.var, ast.Term('Int')), self.context, True)
+        self.var.runtime_depends = [self.var]
+        self.body = Block(ast_node.body, self.context)
+        self.type = context.resolve_type(None)
+        self.check_independent(context)
+
+        local = self.locals()
+        self.runtime_depends = []
+        for rd in self.lo.runtime_depends + self.hi.runtime_depends + self.body.runtime_depends:
+            if rd not in local and rd not in self.runtime_depends:
+                self.runtime_depends.append(rd)
+        # results are only known once the loop ran, even with constant bounds and body
+        for kind, var in self.reductions:
+            var.runtime_depends = [var]
+            if var not in self.runtime_depends:
+                self.runtime_depends.append(var)
+
+    def locals(self):
+        res = set(n for n in walk(self.body) if isinstance(n, VarDef))
+        res.add(self.var)
+        return res
+
+    def check_independent(self, context):
+        # iterations may run in any order at once: outer variables are only updated by reductions,
+        # which are not read otherwise, and called functions have no side effects
+        local = self.locals()
+        reductions = dict((var, kind) for kind, var in self.reductions)
+        reducing = set()
+        for node in walk(self.body):
+            if isinstance(node, Assignment) and node.destination not in local:
+                var = node.destination
+                if var not in reductions:
+                    raise ModelError('parallel iterations assign %s' % var.name, node.ast_node)
+                fn = REDUCTIONS[reductions[var]][0]
+                value = node.value
+                if not (isinstance(value, Call) and isinstance(value.callee, Builtin) and value.callee.name == fn and
+                        isinstance(value.args[0], VarRef) and value.args[0].var_def is var):
+                    raise ModelError('%s reduction must be %s = %s(%s, ...)' % (
+                        reductions[var], var.name, fn, var.name), node.ast_node)
+                reducing.add(value.args[0])
+            elif isinstance(node, VarRef) and node.var_def in reductions and node not in reducing:
+                raise ModelError('reduction variable is read in parallel iterations: %s' % node.var_def.name,
+                                 node.ast_node)
+            elif isinstance(node, Call):
+                for var in node.references():
+                    if var not in local:
+                        raise ModelError('parallel iterations assign %s' % var.name, node.ast_node)
+                if node.callee.runtime_depends:
+                    raise ModelError('parallel iterations call an unknown function', node.ast_node)
+                callee = node.callee.execute(context)
+                for rd in callee.call_runtime_depends:
+                    if isinstance(rd, VarDef) and (rd.readonly or rd in local):
+                        continue
+                    if getattr(rd, 'parallel_safe', False):
+                        continue
+                    raise ModelError('parallel iterations call %s, it depends on %s' % (
+                        callee, getattr(rd, 'name', rd)), node.ast_node)
+
+    def __str__(self):
+        reductions = ', '.join('%s(%s)' % (kind, var.name) for kind, var in self.reductions)
+        return 'Parallel(%s in %s, %s reduce %s) %s' % (self.var.name, self.lo, self.hi, reductions, self.body)
+
+    def run_chunk(self, context, lo, hi):
+        scope = RuntimeContext(context)
+        for kind, var in self.reductions:
+            scope.register_value(var.name)
+            scope.assign_value(var.name, Value(REDUCTIONS[kind][1], var.type, None))
+        for i in xrange(lo, hi):
+            iteration = RuntimeContext(scope)
+            iteration.register_value(self.var.name)
+            iteration.assign_value(self.var.name, Value(i, self.var.type, None))
+            self.body.execute(iteration)
+        return [scope.get_value(var.name).value for kind, var in self.reductions]
+
+    def execute(self, context):
+        global _parallel_job
+        lo = self.lo.execute(context).value
+        hi = self.hi.execute(context).value
+        workers = PARALLEL_WORKERS or multiprocessing.cpu_count()
+        if _in_parallel_worker or workers < 2 or hi - lo < PARALLEL_MIN_ITERATIONS:
+            results = [self.run_chunk(context, lo, hi)]
+        else:
+            # forked workers inherit the model, the runtime context and pending output,
+            # only bounds and results are sent
+            step = (hi - lo + workers - 1) // workers
+            self.output.flush()
+            _parallel_job = self, context
+            pool = multiprocessing.Pool(workers, _start_parallel_worker)
+            try:
+                chunks = [(start, min(start + step, hi)) for start in xrange(lo, hi, step)]
+                results = pool.map(_run_parallel_chunk, chunks)
+            finally:
+                pool.terminate()
+                pool.join()
+                _parallel_job = None
+        for idx, (kind, var) in enumerate(self.reductions):
+            value = reduce(REDUCTIONS[kind][2], [res[idx] for res in results], context.get_value(var.name).value)
+            context.assign_value(var.name, Value(value, var.type, None))
+
 class Enum(Expression):
+    # members are dense codes from 0, each has one preallocated value
     def __init__(self, ast_node, context):
+        Expression.__init__(self, ast_node)
+        self.name = ast_node.name
         self.values = ast_node.values
         self.runtime_depends = []
         self.type = BUILTIN_META_TYPE
+        self.codes = {}
         self.attr_types = {}
         for value in self.values:
+            if value in self.codes:
+                raise AlreadyDefined(value, ast_node)
+            self.codes[value] = len(self.codes)
             self.attr_types[value] = self
+        self.members = [Value(code, self, None) for code in xrange(len(self.values))]
 
     def execute(self, context):
         return self
 
     def get_attr(self, context, name):
-        assert name in self.values
-        return Value(name, self, None)
+        return self.members[self.codes[name]]
 
     def __str__(self):
+        if self.name:
+            return self.name
         return 'Enum(%s)' % ', '.join(self.values)
 
+class Match(Expression):
+    child_fields = ('value', 'arms')
+
+    def __init__(self, ast_node, context):
+        Expression.__init__(self, ast_node)
+        self.value = context.create_expression(ast_node.value)
+        enum = unwrap(self.value.type)
+        if not isinstance(enum, Enum):
+            raise ModelError('match needs an enum value: %s' % self.value.type, ast_node)
+        # jump table, the arm of every member by code
+        self.table = [None] * len(enum.values)
+        self.arms = []
+        # only one arm runs, like a loop body the arms are not executed while building the model
+        self.context = Context(context, self)
+        default = None
+        for arm in ast_node.arms:
+            if arm.names is None:
+                if default is not None:
+                    raise ModelError('match has several else arms', arm)
+                default = len(self.arms)
+            for name in arm.names or ():
+                if name not in enum.codes:
+                    raise NoSuchAttribute(enum, name, arm)
+                if self.table[enum.codes[name]] is not None:
+                    raise ModelError('match arm is repeated: %s' % name, arm)
+                self.table[enum.codes[name]] = len(self.arms)
+            self.arms.append(Block(arm.body, self.context))
+        if default is not None:
+            self.table = [default if idx is None else idx for idx in self.table]
+        missing = [name for name in enum.values if self.table[enum.codes[name]] is None]
+        if missing:
+            raise ModelError('match is not exhaustive, missing: %s' % ', '.join(missing), ast_node)
+
+        local = set(n for arm in self.arms for n in walk(arm) if isinstance(n, VarDef))
+        self.runtime_depends = []
+        for rd in self.value.runtime_depends + [rd for arm in self.arms for rd in arm.runtime_depends]:
+            if rd not in local and rd not in self.runtime_depends:
+                self.runtime_depends.append(rd)
+        # which arm assigned them is only known at runtime
+        for var in assigned(self):
+            if var not in local:
+                var.runtime_depends = [var]
+        if self.arms and all(arm.type == self.arms[0].type for arm in self.arms):
+            self.type = self.arms[0].type
+
+    def __str__(self):
+        return 'Match(%s, %s)' % (self.value, ', '.join(map(str, self.arms)))
+
+    def execute(self, context):
+        return self.arms[self.table[self.value.execute(context).value]].execute(context)
+
+class RecordType(Node):
+    # fields are kept in slots in declaration order, values are tuples indexed by slot
+    def __init__(self, ast_node, context):
+        Node.__init__(self, ast_node)
+        self.name = ast_node.name
+        self.type = BUILTIN_META_TYPE
+        self.runtime_depends = []
+        self.fields = []
+        self.slots = {}
+        for member in ast_node.members:
+            if member.name in self.slots:
+                raise AlreadyDefined(member.name, member)
+            self.slots[member.name] = len(self.fields)
+            ftype = unwrap(context.resolve_type(member.type))
+            if isinstance(ftype, RefType):
+                raise ModelError('references are only allowed as parameters', member)
+            self.fields.append((member.name, ftype))
+
+    def key(self):
+        # named records are distinct types, anonymous ones are equal if their fields are
+        if self.name:
+            return id(self)
+        return tuple(self.fields)
+
+    def __eq__(self, other):
+        return isinstance(other, RecordType) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        if self.name:
+            return self.name
+        return 'Record(%s)' % ', '.join('%s: %s' % field for field in self.fields)
+
+    def execute(self, context):
+        return self
+
+class RecordValue(object):
+    __slots__ = ('type', 'fields')
+
+    def __init__(self, type, fields):
+        self.type = type
+        self.fields = fields
+
+    def __str__(self):
+        return '%s(%s)' % (self.type, ', '.join(map(str, self.fields)))
+
+    def children(self):
+        return iter(self.fields)
+
+class Construct(Expression):
+    child_fields = ('args',)
+
+    def __init__(self, ast_node, record, context):
+        Expression.__init__(self, ast_node)
+        self.type = record
+        self.args = [context.create_expression(arg) for arg in ast_node.args]
+        if len(record.fields) != len(self.args):
+            raise ModelError('Argument count mismatch', ast_node)
+        for (name, ftype), arg in zip(record.fields, self.args):
+            check_assignable_from(ftype, arg.type, ast_node)
+        runtime_depends = set()
+        for arg in self.args:
+            runtime_depends |= set(arg.runtime_depends)
+        self.runtime_depends = list(runtime_depends)
+
+    def __str__(self):
+        return '%s(%s)' % (self.type, ', '.join(map(str, self.args)))
+
+    def execute(self, context):
+        return RecordValue(self.type, tuple(arg.execute(context) for arg in self.args))
+
+class Field(Expression):
+    child_fields = ('obj',)
+
+    def __init__(self, ast_node, obj):
+        Expression.__init__(self, ast_node)
+        self.obj = obj
+        self.name = ast_node.attribute
+        record = unwrap(obj.type)
+        if self.name not in record.slots:
+            raise NoSuchAttribute(record, self.name, ast_node)
+        # resolved once here, execution only indexes the value
+        self.slot = record.slots[self.name]
+        self.type = record.fields[self.slot][1]
+        self.runtime_depends = list(obj.runtime_depends)
+
+    def __str__(self):
+        return '%s.%s' % (self.obj, self.name)
+
+    def execute(self, context):
+        return self.obj.execute(context).fields[self.slot]
+
 class Function(Expression):
+    child_fields = ('args', 'body')
+
     def __init__(self, ast_node, context):
         Expression.__init__(self, ast_node)
 
         self.return_type = context.resolve_type(ast_node.return_type)
+        if isinstance(unwrap(self.return_type), RefType):
+            raise ModelError('references are only allowed as parameters', ast_node)
             
         while True:
             try:
@@ -335,12 +800,14 @@ class Function(Expression):
                 raise
 
         self.runtime_depends = []
-        self.call_runtime_depends = filter(lambda x: x not in self.args, self.body.runtime_depends)
+        # variables of the function itself, arguments included, are not dependencies of its calls
+        self.call_runtime_depends = [rd for rd in self.body.runtime_depends
+                                     if not (isinstance(rd, VarDef) and rd.owner is self)]
 
         if self.return_type:
             check_assignable_from(self.return_type, self.body.type, ast_node)
 
-        arg_types = [arg.type for arg in self.args]
+        arg_types = [arg.ref_type if arg.by_ref else arg.type for arg in self.args]
         self.type = FuncType(arg_types, self.return_type)
 
     def __str__(self):
@@ -356,7 +823,39 @@ class Function(Expression):
             arg_context.assign_value(arg.name, val)
         return self.body.execute(arg_context)
 
+class ExternFunction(Builtin):
+    # a function of another module, only its signature is known while building the model
+    def __init__(self, module, name, symbol, type, loader):
+        Builtin.__init__(self)
+        self.module = module
+        self.export_name = name
+        self.name = symbol
+        self.type = type
+        self.loader = loader
+        self.runtime_depends = []
+        self.call_runtime_depends = [self]
+        # print buffer of the importing program
+        self.output = None
+
+    def __str__(self):
+        return 'ExternFunction(%s.%s)' % (self.module, self.export_name)
+
+    def execute(self, context):
+        return self
+
+    def call(self, context, args):
+        # runs in the frame of its own module, globals are looked up there;
+        # each module prints through its own buffer, they are flushed in call order
+        program = self.loader.model(self.module)
+        self.output.flush()
+        try:
+            return program.get_value(self.export_name).call(program, args)
+        finally:
+            program.output.flush()
+
 class PrecompiledExpression(Node):
+    child_fields = ('expr',)
+
     def __init__(self, ast_node, value, expr):
         Node.__init__(self, ast_node)
         self.value = value
@@ -389,6 +888,14 @@ class RuntimeContext(object):
         else:
             raise Undefined(name, None)
 
+    def cell(self, name):
+        if name in self.names:
+            return Cell(self, name)
+        elif self.parent:
+            return self.parent.cell(name)
+        else:
+            raise Undefined(name, None)
+
     def get_value(self, name):
         if name in self.names:
             if name in self.values:
@@ -417,16 +924,30 @@ class Context(RuntimeContext):
                 return term
         elif isinstance(ast_node, ast.Enum):
             return Enum(ast_node, self)
+        elif isinstance(ast_node, ast.Tuple):
+            return RecordType(ast_node, self)
+        elif isinstance(ast_node, ast.Ref):
+            return RefType(ast_node, self)
         elif isinstance(ast_node, ast.AttributeAccess):
-            return AttributeAccess(ast_node, self)
+            obj = self.create_expression(ast_node.obj)
+            if isinstance(unwrap(obj.type), RecordType):
+                return Field(ast_node, obj)
+            return AttributeAccess(ast_node, self, obj)
         elif isinstance(ast_node, ast.Func):
             return Function(ast_node, self)
         elif isinstance(ast_node, ast.Call):
-            return Call(ast_node, self)
+            callee = self.create_expression(ast_node.callee)
+            if isinstance(unwrap(callee), RecordType):
+                return Construct(ast_node, unwrap(callee), self)
+            return Call(ast_node, self, callee)
         elif isinstance(ast_node, ast.If):
             return If(ast_node, self)
+        elif isinstance(ast_node, ast.Match):
+            return Match(ast_node, self)
         elif isinstance(ast_node, ast.While):
             return While(ast_node, self)
+        elif isinstance(ast_node, ast.Parallel):
+            return Parallel(ast_node, self)
         elif isinstance(ast_node, ast.Value):
             vtype = self.resolve_type(ast_node.type)
             return Value(ast_node.value, vtype, ast_node)
@@ -470,6 +991,8 @@ class Context(RuntimeContext):
         self.terms[name] = value
 
 class Block(Expression, Context):
+    child_fields = ('statements',)
+
     def __init__(self, ast_node, parent, import_terms=False):
         if import_terms:
             Context.__init__(self, None)
@@ -484,7 +1007,9 @@ class Block(Expression, Context):
             self.add_statement(st)
 
     def add_statement(self, ast_node):
-        if isinstance(ast_node, ast.Var):
+        if isinstance(ast_node, ast.Import):
+            raise ModelError('imports are only allowed at the top level', ast_node)
+        elif isinstance(ast_node, ast.Var):
             res = VarDef(ast_node, self)
             self.type = self.resolve_type(None)
         elif isinstance(ast_node, ast.Assignment):
@@ -509,31 +1034,80 @@ class Block(Expression, Context):
 
     def execute(self, context):
         res = None
+        scope = RuntimeContext(context)
         for st in self.statements:
-            res = st.execute(context)
+            res = st.execute(scope)
         return res
 
 class Program(Block):
-    def __init__(self, ast_node, builtins):
+    def __init__(self, ast_node, builtins, loader=None):
+        self.loader = loader
+        self.output = builtins.output
+        self.imports = []
+        self.externs = []
+        # definitions used by other modules, kept alive like main
+        self.exports = []
         Block.__init__(self, ast_node, builtins, True)
-    
+
+    def add_statement(self, ast_node):
+        if isinstance(ast_node, ast.Import):
+            return self.import_module(ast_node)
+        res = Block.add_statement(self, ast_node)
+        # globals are initialized while building the model and by C initializers, arrays and bytes can't be
+        if isinstance(res, VarDef) and res.runtime_depends:
+            raise ModelError('global initializer is not a compile time constant: %s' % res.name, ast_node)
+        return res
+
+    def import_module(self, ast_node):
+        if self.loader is None:
+            raise ModelError('imports need a module loader', ast_node)
+        if ast_node.module in self.imports:
+            return
+        for name, term in self.loader.exports(ast_node.module, self, ast_node):
+            self.add_term(name, term, ast_node)
+            if isinstance(term, ExternFunction):
+                term.output = self.output
+                self.externs.append(term)
+        self.imports.append(ast_node.module)
+
     def __str__(self):
         return '\n'.join(map(str, self.statements))
 
-def build_model(code, output=sys.stdout):
+def build_model(code, output=sys.stdout, timings=None, loader=None):
     import model # sigh, import self to have matching classes in builtins and here
     import parse
+    import lexer
     import builtins
-
-    program_ast = parse.parse(code)
-    builtins_context = builtins.Builtins(output)
-    program_model = model.Program(program_ast, builtins_context)
+    import timing
+
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase('lex') as phase:
+        lex = lexer.tokenize(code)
+        phase.count('tokens', len(lex.token_list))
+    with timings.phase('parse') as phase:
+        program_ast = parse.parse(code, lex=lex)
+        phase.count('ast_nodes', sum(1 for node in ast.walk(program_ast)))
+    with timings.phase('builtins'):
+        builtins_context = builtins.Builtins(output)
+    with timings.phase('model') as phase:
+        program_model = model.Program(program_ast, builtins_context, loader)
+        nodes = list(model.walk(program_model))
+        phase.count('model_nodes', len(nodes))
+        phase.count('precompiled', sum(1 for node in nodes if isinstance(node, model.PrecompiledExpression)))
     return program_model
 
-def run_model(m):
-    #main = m.resolve_term('main', None)
-    main = m.get_value('main')
-    res = main.call(m, [])
+def run_model(m, timings=None):
+    import timing
+    if timings is None:
+        timings = timing.NULL_TIMINGS
+    with timings.phase('interpret'):
+        #main = m.resolve_term('main', None)
+        main = m.get_value('main')
+        try:
+            res = main.call(m, [])
+        finally:
+            m.output.flush()
     if res:
         return res.value
 
@@ -544,14 +1118,27 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--run', action='store_true')
+    parser.add_argument('--timings', action='store_true', help='print per-phase timings to stderr')
+    parser.add_argument('--timings-json', metavar='PATH', help='write per-phase timings as json, - for stdout')
     parser.add_argument('path')
+    import optimizer
+    import modules
+    optimizer.add_arguments(parser)
+    modules.add_arguments(parser)
     args = parser.parse_args()
     
+    import timing
+    timings = timing.Timings() if args.timings or args.timings_json else None
     content = open(args.path).read()
-    m = build_model(content)
+    optimize = lambda m: optimizer.optimize_from_args(m, args, timings)
+    loader = modules.loader_from_args(args.path, args, timings=timings, optimize=optimize)
+    m = build_model(content, timings=timings, loader=loader)
+    optimize(m)
     print m
     if args.run:
-        res = run_model(m)
+        res = run_model(m, timings)
         print 'res=%s' % res
+    if timings:
+        timing.report(timings, sys.stderr if args.timings else None, args.timings_json)
     
     
@@ -0,0 +1,220 @@
+#!env python2.7
+import os
+import sys
+import json
+import errno
+import hashlib
+import tempfile
+import logging
+import ast
+import model
+
+logger = logging.getLogger('modules')
+
+EXTENSION = '.epl'
+INTERFACE_EXTENSION = '.epli'
+INTERFACE_VERSION = 2
+
+def symbol(module, name):
+    # length prefixed, user names start with a letter, so nothing can collide with it
+    return '_M%s%s_%s' % (len(module), module, name)
+
+def _unwrap(node):
+    if isinstance(node, model.PrecompiledExpression):
+        return node.value
+    return node
+
+def _type_name(t):
+    t = _unwrap(t)
+    if isinstance(t, model.Builtin) and t.type is model.BUILTIN_META_TYPE:
+        return t.name
+
+def exports(program):
+    # functions over builtin types and constants, other definitions stay private to the module
+    for st in program.statements:
+        if not isinstance(st, model.VarDef) or not st.readonly or st.name == 'main':
+            continue
+        value = _unwrap(st.value)
+        if isinstance(value, model.Function):
+            types = [_type_name(t) for t in value.type.arg_types + [value.type.return_type]]
+            if None not in types:
+                yield st.name, dict(kind='function', args=types[:-1], result=types[-1])
+        elif isinstance(value, model.Value) and isinstance(value.value, (bool, int, long, float)):
+            vtype = _type_name(value.type)
+            if vtype:
+                yield st.name, dict(kind='constant', type=vtype, value=value.value)
+
+def export_symbols(program, module):
+    names = set(program.exports)
+    res = {}
+    for st in program.statements:
+        if isinstance(st, model.VarDef) and st.name in names:
+            value = _unwrap(st.value)
+            if isinstance(value, model.Function):
+                res[value] = symbol(module, st.name)
+    return res
+
+def digest(source):
+    return hashlib.sha256(source).hexdigest()
+
+def interface_digest(interface):
+    return digest(json.dumps(interface, sort_keys=True))
+
+_frontend = []
+
+def frontend_digest():
+    # objects of unchanged modules are reused, a change of the compiler itself must rebuild them
+    if not _frontend:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.sha256()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    h.update(digest(f.read()))
+        _frontend.append(h.hexdigest())
+    return _frontend[0]
+
+class Loader(object):
+    # finds, builds and describes imported modules, each one once per loader
+    def __init__(self, search_path=('.',), build_dir=None, output=sys.stdout, timings=None, optimize=None,
+                 variant=None):
+        self.search_path = list(search_path)
+        self.build_dir = build_dir
+        self.output = output
+        self.timings = timings
+        self.optimize = optimize
+        # describes what optimize does, without it objects of modules are keyed by their C source
+        self.variant = variant
+        self.models = {}
+        self.interfaces = {}
+        self.loading = []
+
+    def path(self, name, ast_node=None):
+        for directory in self.search_path:
+            path = os.path.join(directory, name + EXTENSION)
+            if os.path.isfile(path):
+                return path
+        raise model.ModelError('module not found: %s' % name, ast_node)
+
+    def source(self, name, ast_node=None):
+        with open(self.path(name, ast_node)) as f:
+            return f.read()
+
+    def model(self, name, ast_node=None):
+        if name not in self.models:
+            if name in self.loading:
+                raise model.ModelError('import cycle: %s' % ' -> '.join(self.loading + [name]), ast_node)
+            source = self.source(name, ast_node)
+            self.loading.append(name)
+            try:
+                m = model.build_model(source, self.output, self.timings, self)
+            finally:
+                self.loading.pop()
+            exported = list(exports(m))
+            m.module = name
+            m.exports = [export_name for export_name, _ in exported]
+            if self.optimize:
+                self.optimize(m)
+            self.models[name] = m
+            if name not in self.interfaces:
+                openmp = any(isinstance(n, model.Parallel) for n in model.walk(m))
+                self.interfaces[name] = self.write_interface(name, digest(source), exported, m.imports, openmp)
+        return self.models[name]
+
+    def interface_path(self, name):
+        return os.path.join(self.build_dir, name + INTERFACE_EXTENSION)
+
+    def read_interface(self, name, source_digest):
+        if self.build_dir is None:
+            return None
+        try:
+            with open(self.interface_path(name)) as f:
+                interface = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if interface.get('version') != INTERFACE_VERSION or interface.get('source') != source_digest:
+            return None
+        # constants of imported modules end up in the exports, their changes make it stale too
+        self.loading.append(name)
+        try:
+            for import_name, import_digest in interface['dependencies'].items():
+                if interface_digest(self.interface(import_name)) != import_digest:
+                    return None
+        finally:
+            self.loading.pop()
+        return interface
+
+    def write_interface(self, name, source_digest, exported, imports, openmp):
+        dependencies = dict((import_name, interface_digest(self.interface(import_name))) for import_name in imports)
+        interface = dict(version=INTERFACE_VERSION, module=name, source=source_digest,
+                         exports=[dict(export, name=export_name) for export_name, export in exported],
+                         imports=list(imports), dependencies=dependencies, openmp=openmp)
+        if self.build_dir is None:
+            return interface
+        if not os.path.isdir(self.build_dir):
+            try:
+                os.makedirs(self.build_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # renamed into place, concurrent builds never read a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.build_dir, suffix=INTERFACE_EXTENSION)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(interface, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.interface_path(name))
+        return interface
+
+    def interface(self, name, ast_node=None):
+        # importers only need signatures, an up to date interface file saves building the module
+        if name not in self.interfaces:
+            if name in self.loading:
+                raise model.ModelError('import cycle: %s' % ' -> '.join(self.loading + [name]), ast_node)
+            interface = self.read_interface(name, digest(self.source(name, ast_node)))
+            if interface is None:
+                self.model(name, ast_node)
+            else:
+                logger.debug('interface of %s is up to date', name)
+                self.interfaces[name] = interface
+        return self.interfaces[name]
+
+    def exports(self, name, context, ast_node=None):
+        resolve = lambda type_name: context.resolve_type(ast.Term(type_name))
+        for export in self.interface(name, ast_node)['exports']:
+            if export['kind'] == 'function':
+                ftype = model.FuncType([resolve(t) for t in export['args']], resolve(export['result']))
+                term = model.ExternFunction(name, export['name'], symbol(name, export['name']), ftype, self)
+            else:
+                term = model.Value(export['value'], resolve(export['type']), ast_node)
+            yield export['name'], term
+
+    def object_digest(self, name):
+        # names the compiled module without building it, None when the optimizations are not known
+        if self.variant is None:
+            return None
+        return digest('\0'.join([frontend_digest(), self.variant, interface_digest(self.interface(name))]))
+
+def dependencies(program):
+    # modules imported by the program directly or not, each after the modules it imports;
+    # read from the interfaces, modules are built only if theirs are stale
+    order = []
+    def visit(imports, path):
+        for name in imports:
+            if name in path:
+                raise model.ModelError('import cycle: %s' % ' -> '.join(path + [name]), None)
+            if name not in order:
+                visit(program.loader.interface(name)['imports'], path + [name])
+                order.append(name)
+    visit(program.imports, [])
+    return order
+
+def default_build_dir(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), '.explo')
+
+def add_arguments(parser):
+    parser.add_argument('-I', dest='module_path', action='append', default=[], metavar='DIR',
+                        help='search imported modules here after the directory of the program')
+    parser.add_argument('--build-dir', metavar='PATH', help='interface files, default .explo next to the program')
+
+def loader_from_args(path, args, output=sys.stdout, timings=None, optimize=None, variant=None):
+    search_path = [os.path.dirname(os.path.abspath(path))] + args.module_path
+    return Loader(search_path, args.build_dir or default_build_dir(path), output, timings, optimize, variant)
@@ -0,0 +1,360 @@
+#!env python2.7
+import sys
+import logging
+import collections
+import model
+import error
+import timing
+
+logger = logging.getLogger('optimizer')
+
+class VerificationError(error.OptimizerError):
+    def __init__(self, message, node, pass_name=None):
+        error.OptimizerError.__init__(self, message)
+        self.node = node
+        self.pass_name = pass_name
+
+    def __str__(self):
+        return '%s\nafter pass: %s\nat: %s' % (self.message, self.pass_name, self.node)
+
+def unwrap(node):
+    if isinstance(node, model.PrecompiledExpression):
+        return node.value
+    return node
+
+def is_bool_type(t):
+    t = unwrap(t)
+    return isinstance(t, model.Builtin) and t.name == 'Bool'
+
+class Verifier(object):
+    def __init__(self, pass_name=None):
+        self.pass_name = pass_name
+        self.seen = set()
+
+    def fail(self, message, node):
+        raise VerificationError(message, node, self.pass_name)
+
+    def verify(self, program):
+        self.visit(program, [set()])
+
+    def visit(self, node, scopes):
+        if not isinstance(node, model.Node):
+            self.fail('not a model node: %r' % node, node)
+        if not isinstance(node, (model.Builtin, model.Value)):
+            if id(node) in self.seen:
+                self.fail('node is shared between several parents', node)
+            self.seen.add(id(node))
+
+        if isinstance(node, model.PrecompiledExpression):
+            # evaluated while building the model, the expression is kept for reference only
+            return
+        elif isinstance(node, model.Block):
+            scopes = scopes + [set()]
+            for st in node.statements:
+                self.visit(st, scopes)
+            return
+        elif isinstance(node, model.Function):
+            scopes = scopes + [set()]
+            for arg in node.args:
+                self.visit(arg, scopes)
+            self.visit(node.body, scopes)
+            return
+        elif isinstance(node, (model.While, model.Parallel)):
+            scopes = scopes + [set()]
+        elif isinstance(node, model.VarRef):
+            if not any(node.var_def in scope for scope in scopes):
+                self.fail('reference to invisible variable: %s' % node.var_def.name, node)
+        elif isinstance(node, model.Assignment):
+            if not any(node.destination in scope for scope in scopes):
+                self.fail('assignment to invisible variable: %s' % node.destination.name, node)
+            if node.destination.readonly:
+                self.fail('assignment to readonly variable: %s' % node.destination.name, node)
+        elif isinstance(node, model.Call):
+            ftype = node.callee.type
+            if not isinstance(ftype, model.FuncType):
+                self.fail('not callable: %s' % ftype, node)
+            if len(ftype.arg_types) != len(node.args):
+                self.fail('argument count mismatch', node)
+            for exp_type, arg in zip(ftype.arg_types, node.args):
+                try:
+                    model.check_assignable_from(exp_type, arg.type, node.ast_node)
+                except model.TypeMismatch as e:
+                    self.fail(e.message, node)
+
+        if isinstance(node, (model.If, model.While)) and not is_bool_type(node.condition.type):
+            self.fail('condition is not Bool: %s' % node.condition.type, node)
+
+        for child in node.children():
+            self.visit(child, scopes)
+        if isinstance(node, model.VarDef):
+            scopes[-1].add(node)
+
+def verify(program, pass_name=None):
+    Verifier(pass_name).verify(program)
+
+def make_block(statements, type, owner, ast_node=None):
+    block = model.Block.__new__(model.Block)
+    model.Context.__init__(block, None, owner)
+    model.Expression.__init__(block, ast_node)
+    block.type = type
+    block.runtime_depends = []
+    block.statements = statements
+    return block
+
+def make_var(name, value, type, owner, readonly=True, ast_node=None):
+    var = model.VarDef.__new__(model.VarDef)
+    model.Node.__init__(var, ast_node)
+    var.owner = owner
+    var.readonly = readonly
+    var.name = name
+    var.value = value
+    var.type = type
+    var.runtime_depends = list(value.runtime_depends) if value else []
+    return var
+
+def make_ref(var_def, ast_node=None):
+    ref = model.VarRef.__new__(model.VarRef)
+    model.Expression.__init__(ref, ast_node)
+    ref.var_def = var_def
+    ref.type = var_def.type
+    ref.runtime_depends = [var_def]
+    return ref
+
+def local_definitions(function):
+    # variables of the function itself that only it writes, calls can't change them;
+    # nested functions have their own scope, what they assign in this one is left out
+    stack = [function.body]
+    res = set()
+    nested = []
+    while stack:
+        node = stack.pop()
+        if isinstance(node, model.Function):
+            nested.append(node)
+            continue
+        if isinstance(node, model.VarDef):
+            res.add(node)
+        stack.extend(node.children())
+    for f in nested:
+        res -= model.assigned(f)
+    return res
+
+def size(node):
+    return sum(1 for _ in model.walk(node))
+
+def substitute(node, replacements):
+    if id(node) in replacements:
+        return make_ref(replacements[id(node)], node.ast_node)
+    node.map_children(lambda child: substitute(child, replacements))
+    return node
+
+def expression_key(node):
+    # structural identity of side effect free expressions, None if not comparable
+    node = unwrap(node)
+    if isinstance(node, model.Value):
+        if isinstance(node.value, (bool, int, long, float, str)):
+            return ('value', type(node.value), node.value, id(node.type))
+    elif isinstance(node, model.VarRef):
+        return ('ref', id(node.var_def))
+    elif isinstance(node, (model.Builtin, model.Function)):
+        return ('callee', id(node))
+    elif isinstance(node, model.Call):
+        keys = [expression_key(node.callee)] + [expression_key(arg) for arg in node.args]
+        if None not in keys:
+            return ('call',) + tuple(keys)
+
+class Purity(object):
+    # pure callees have no side effects and depend only on arguments and immutable state,
+    # total ones additionally always terminate without an error
+    def __init__(self):
+        self.functions = {}
+
+    def callee(self, callee):
+        callee = unwrap(callee)
+        if isinstance(callee, model.Builtin):
+            pure = hasattr(callee, 'call') and not callee.call_runtime_depends
+            return pure, pure and not getattr(callee, 'partial', False)
+        elif isinstance(callee, model.Function):
+            if callee not in self.functions:
+                self.functions[callee] = (False, False)
+                self.functions[callee] = self.analyze(callee)
+            return self.functions[callee]
+        return False, False
+
+    def analyze(self, function):
+        # writes through ref parameters are side effects on the caller
+        if any(arg.by_ref for arg in function.args):
+            return False, False
+        local = set(n for n in model.walk(function) if isinstance(n, model.VarDef))
+        pure = total = True
+        for node in model.walk(function.body):
+            if isinstance(node, model.Function):
+                return False, False
+            elif isinstance(node, (model.While, model.Parallel)):
+                total = False
+            elif isinstance(node, model.Assignment) and node.destination not in local:
+                return False, False
+            elif isinstance(node, model.VarRef) and node.var_def not in local and not node.var_def.readonly:
+                return False, False
+            elif isinstance(node, model.Call):
+                cpure, ctotal = self.callee(node.callee)
+                pure = pure and cpure
+                total = total and ctotal
+        return pure, pure and total
+
+    def expression(self, node, total=False):
+        if isinstance(node, (model.PrecompiledExpression, model.Value, model.VarRef, model.Builtin)):
+            return True
+        elif isinstance(node, model.Call):
+            pure, is_total = self.callee(node.callee)
+            if not pure or (total and not is_total):
+                return False
+            return all(self.expression(arg, total) for arg in node.args)
+        return False
+
+    def modifies_globals(self, node):
+        for n in model.walk(node):
+            if isinstance(n, model.Call):
+                callee = unwrap(n.callee)
+                # functions of other modules may call back into this one
+                if isinstance(callee, model.ExternFunction):
+                    return True
+                if not isinstance(callee, model.Builtin) and not self.callee(callee)[0]:
+                    return True
+        return False
+
+PASSES = collections.OrderedDict()
+
+def register(cls):
+    PASSES[cls.name] = cls
+    return cls
+
+class Pass(object):
+    name = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def run(self, program):
+        raise NotImplementedError(type(self))
+
+    def report(self):
+        return []
+
+def has_side_effects(node):
+    if isinstance(node, model.Block) and not node.statements:
+        return False
+    # precompiled statements were already executed when the model was built
+    return not isinstance(node, (model.PrecompiledExpression, model.Value, model.VarRef,
+                                 model.Builtin, model.Function))
+
+@register
+class DeadStatements(Pass):
+    name = 'dead-statements'
+
+    def run(self, program):
+        changes = 0
+        for node in model.walk(program):
+            if not isinstance(node, model.Block) or len(node.statements) < 2:
+                continue
+            last = node.statements[-1]
+            statements = [st for st in node.statements[:-1] if has_side_effects(st)]
+            changes += len(node.statements) - 1 - len(statements)
+            node.statements = statements + [last]
+        return changes
+
+LEVELS = {
+    0: [],
+    1: ['constprop', 'dead-statements', 'dead-definitions'],
+    2: ['licm', 'cse', 'inline', 'constprop', 'dead-statements', 'dead-definitions'],
+}
+
+class PassManager(object):
+    def __init__(self, passes, verify=True, timings=None, options=None):
+        self.passes = []
+        for name in passes:
+            if name not in PASSES:
+                raise error.OptimizerError('unknown pass: %s' % name)
+            self.passes.append(PASSES[name](options or {}))
+        self.verify = verify
+        self.timings = timings or timing.NULL_TIMINGS
+        self.changes = collections.OrderedDict((p.name, 0) for p in self.passes)
+
+    def run(self, program):
+        for p in self.passes:
+            with self.timings.phase('pass:%s' % p.name) as phase:
+                changes = p.run(program)
+                phase.count('changes', changes)
+            logger.debug('pass %s: %s changes', p.name, changes)
+            self.changes[p.name] += changes
+            if self.verify:
+                with self.timings.phase('verify'):
+                    verify(program, p.name)
+        return sum(self.changes.values())
+
+    def report(self):
+        lines = []
+        for p in self.passes:
+            lines.append('%s: %s changes' % (p.name, self.changes[p.name]))
+            lines += ['  ' + line for line in p.report()]
+        return '\n'.join(lines)
+
+def pass_list(level=0, passes=None):
+    if passes is not None:
+        return [name for name in passes.split(',') if name]
+    return LEVELS[level]
+
+def optimize(program, level=0, passes=None, verify=True, timings=None, options=None):
+    manager = PassManager(pass_list(level, passes), verify, timings, options)
+    manager.run(program)
+    return manager
+
+def variant(level=0, passes=None, options=None):
+    # what optimize does to a model, compiled modules are reused only for the same
+    return repr((list(pass_list(level, passes)), sorted((options or {}).items())))
+
+def add_arguments(parser):
+    parser.add_argument('-O', dest='opt_level', type=int, choices=sorted(LEVELS), default=0,
+                        help='optimization level')
+    parser.add_argument('--passes', help='comma separated pass list, overrides -O')
+    parser.add_argument('--no-verify', action='store_true', help='do not verify the model between passes')
+    parser.add_argument('--report', action='store_true', help='print what optimization passes changed to stderr')
+    parser.add_argument('--export', action='append', default=[], metavar='NAME',
+                        help='keep the definition alive in addition to main')
+    parser.add_argument('--inline-budget', type=int, metavar='NODES', help='largest function body to inline')
+
+def options_from_args(args):
+    return {
+        'exports': args.export,
+        'inline_budget': args.inline_budget,
+    }
+
+def optimize_from_args(program, args, timings=None):
+    manager = optimize(program, args.opt_level, args.passes, not args.no_verify, timings, options_from_args(args))
+    if args.report:
+        sys.stderr.write(manager.report() + '\n')
+    return manager
+
+def variant_from_args(args):
+    return variant(args.opt_level, args.passes, options_from_args(args))
+
+# pass modules register themselves in PASSES
+import inliner
+import deadcode
+import constprop
+import licm
+import cse
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+
+    import argparse
+    import optimizer # import self to see the passes registered above
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    optimizer.add_arguments(parser)
+    args = parser.parse_args()
+
+    content = open(args.path).read()
+    m = model.build_model(content)
+    optimizer.optimize_from_args(m, args)
+    print m
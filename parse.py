@@ -120,12 +120,32 @@ def p_def_enum(p):
     '''def : ENUM ID LBRACE term_list optional_comma RBRACE
            | ENUM ID LBRACE RBRACE'''
     if len(p) < 5:
-        e = ast.Enum([])
+        e = ast.Enum([], p[2])
     else:
-        e = ast.Enum(p[4])
+        e = ast.Enum(p[4], p[2])
     p[0] = ast.Var(p[2], None, True, e)
     add_srcmap(p, 2)
 
+def p_expr_record(p):
+    '''expr : TYPE LBRACE arg_def_list optional_comma RBRACE'''
+    p[0] = ast.Tuple(p[3])
+    add_srcmap(p, 1)
+
+def p_expr_tuple(p):
+    '''expr : TYPE LPAREN expr_list optional_comma RPAREN'''
+    p[0] = ast.Tuple([ast.Var(str(idx), member) for idx, member in enumerate(p[3])])
+    add_srcmap(p, 1)
+
+def p_def_record(p):
+    '''def : TYPE ID LBRACE arg_def_list optional_comma RBRACE'''
+    p[0] = ast.Var(p[2], None, True, ast.Tuple(p[4], p[2]))
+    add_srcmap(p, 2)
+
+def p_def_import(p):
+    '''def : IMPORT ID'''
+    p[0] = ast.Import(p[2])
+    add_srcmap(p, 2)
+
 def p_expr_term(p):
     '''expr : ID'''
     p[0] = ast.Term(p[1])
@@ -151,6 +171,23 @@ def p_expr_attribute_access(p):
     p[0] = ast.AttributeAccess(p[1], p[3])
     add_srcmap(p, 1)
 
+def p_expr_tuple_access(p):
+    '''expr : expr DOT INT'''
+    p[0] = ast.AttributeAccess(p[1], p[3])
+    add_srcmap(p, 1)
+
+def p_expr_nested_tuple_access(p):
+    '''expr : expr DOT FLOAT'''
+    # the lexer reads t.1.0 as t . 1.0
+    outer, inner = p[3].split('.')
+    p[0] = ast.AttributeAccess(ast.AttributeAccess(p[1], outer), inner)
+    add_srcmap(p, 1)
+
+def p_expr_ref(p):
+    '''expr : REF expr'''
+    p[0] = ast.Ref(p[2])
+    add_srcmap(p, 1)
+
 def p_expr_call(p):
     '''expr : expr LPAREN expr_list optional_comma RPAREN'''
     p[0] = ast.Call(p[1], p[3])
@@ -170,6 +207,45 @@ def p_expr_while(p):
     p[0] = ast.While(p[2], p[3])
     add_srcmap(p, 1)
     
+def p_expr_parallel(p):
+    '''expr : PARALLEL ID IN expr COMMA expr block
+            | PARALLEL ID IN expr COMMA expr REDUCE reduction_list block'''
+    if len(p) > 8:
+        p[0] = ast.Parallel(p[2], p[4], p[6], p[8], p[9])
+    else:
+        p[0] = ast.Parallel(p[2], p[4], p[6], [], p[7])
+    add_srcmap(p, 1)
+
+def p_expr_match(p):
+    '''expr : MATCH expr LBRACE arm_list RBRACE'''
+    p[0] = ast.Match(p[2], p[4])
+    add_srcmap(p, 1)
+
+def p_arm(p):
+    '''arm : term_list block
+           | ELSE block'''
+    if p[1] == 'else':
+        p[0] = ast.Arm(None, p[2])
+    else:
+        p[0] = ast.Arm(p[1], p[2])
+    add_srcmap(p, 2)
+
+def p_arm_list(p):
+    '''arm_list :
+                | arm_list arm
+    '''
+    _process_list(p, sep=0)
+
+def p_reduction(p):
+    '''reduction : ID LPAREN ID RPAREN'''
+    p[0] = (p[1], p[3])
+
+def p_reduction_list(p):
+    '''reduction_list : reduction
+                      | reduction_list COMMA reduction
+    '''
+    _process_list(p)
+
 def p_expr_list(p):
     '''expr_list :
                  | expr
@@ -205,10 +281,15 @@ def p_statement(p):
     else:
         p[0] = p[1]
 
-def parse(content, debug=False):
-    lex = lexer.lexer()
+def parse(content, debug=False, lex=None):
+    if lex is None:
+        lex = lexer.lexer()
+        tokenfunc = None
+    else:
+        token_iter = iter(lex.token_list)
+        tokenfunc = lambda: next(token_iter, None)
     parser = yacc.yacc()
-    res = parser.parse(content, lexer=lex, debug=debug)
+    res = parser.parse(content, lexer=lex, debug=debug, tokenfunc=tokenfunc)
     if res is None or lex.errors:
         errors = '\n'.join(lex.errors)
         if not errors:
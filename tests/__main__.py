@@ -1,11 +1,20 @@
 import sys
 import os
+import shutil
+import tempfile
+import cStringIO
 import logging
 import model
 import error
 import compiler
 import parse
 import traceback
+import timing
+import optimizer
+import cache
+import modules
+import hotspots
+import batch
 
 logger = logging.getLogger('test')
 
@@ -33,9 +42,24 @@ class NoSuccess(TestFailure):
         TestFailure.__init__(self, 'received %s' % type(cause).__name__, code)
         self.cause = cause
 
+def _excerpt(lines, start, count=5):
+    return '\n'.join(lines[start:start + count])
+
 class OutputMismatch(TestFailure):
-    def __init__(self, code, exp, got):
-        TestFailure.__init__(self, '%s output mismatch, expected:\n%s\ngot:\n%s' % (stage, exp, got), code)
+    def __init__(self, stage, code, exp, got):
+        # outputs may be long, only where they start to differ is shown
+        exp, got = exp.splitlines(), got.splitlines()
+        line = next((idx for idx, (a, b) in enumerate(zip(exp, got)) if a != b), min(len(exp), len(got)))
+        TestFailure.__init__(self, '%s output mismatch at line %s, expected:\n%s\ngot:\n%s' % (
+            stage, line + 1, _excerpt(exp, line), _excerpt(got, line)), code)
+
+class CallCountMismatch(TestFailure):
+    def __init__(self, code, name, exp, got, report):
+        TestFailure.__init__(self, 'hotspots expected %s calls of %s, got %s:\n%s' % (exp, name, got, report), code)
+
+class BatchMismatch(TestFailure):
+    def __init__(self, manifest, message, log):
+        TestFailure.__init__(self, 'batch %s, report:\n%s' % (message, log), manifest)
 
 class NoFailure(TestFailure):
     def __init__(self, stage, code, expected):
@@ -58,6 +82,11 @@ class TestFile(object):
         self.output = []
         self.expected_output = []
         self.no_run = False
+        self.opt_level = None
+        # relies on IEEE floats, the binary is not checked when built with fast-math
+        self.ieee = False
+        # function name and call count the hot spot report of an instrumented build shows
+        self.calls = []
         for idx, line in enumerate(self.lines):
             if '//<' in line:
                 code, command = line.split('//<', 1)
@@ -69,7 +98,7 @@ class TestFile(object):
                     else:
                         value = ''
                     if name == 'Output':
-                        self.output.append(value)
+                        self.expected_output.append(value)
                     elif name in ERRORS:
                         self.errors[idx] = ERRORS[name], value
                         self.count += 1
@@ -77,17 +106,56 @@ class TestFile(object):
                         assert False, 'Unknown test command: %s' % name
             if line.strip().startswith('//!no_run'):
                 self.no_run = True
+            if line.strip().startswith('//!opt_level'):
+                self.opt_level = int(line.split()[1])
+            if line.strip().startswith('//!ieee'):
+                self.ieee = True
+            if line.strip().startswith('//!calls'):
+                _, name, count = line.split()
+                self.calls.append((name, int(count)))
 
     def write(self, s):
         self.output.append(s)
 
-    def check_output(self, code):
-        if not self.expected_output:
-            return
-        exp = '\n'.join(self.expected_output)
-        got = ''.join(self.output)
-        if exp != got:
-            raise OutputMismatch(code, exp, got)
+    def run_interpreter(self, m, timings):
+        # prints of the program collect in self.output, a failed run leaves them there
+        self.output = []
+        model.run_model(m, timings)
+        return ''.join(self.output)
+
+    def check_output(self, stage, code, got):
+        if self.expected_output and got.splitlines() != self.expected_output:
+            raise OutputMismatch(stage, code, '\n'.join(self.expected_output), got)
+
+    def check_backends(self, code, interpreted, compiled):
+        # both backends print the same, up to an abort too
+        if interpreted is not None and compiled is not None and interpreted != compiled:
+            raise OutputMismatch('compiler', code, interpreted, compiled)
+
+    def check_calls(self, code, m, timings, binaries):
+        # the probes count into a file of their own, hotspots reads it back like it would explo.profile
+        fd, path = tempfile.mkstemp(prefix='explo_', suffix='.profile')
+        os.close(fd)
+        saved = os.environ.get('EXPLO_PROFILE')
+        os.environ['EXPLO_PROFILE'] = path
+        try:
+            compiler.run_model(m, timings=timings, cache=binaries, profile=compiler.PROFILES['instrumented'])
+            report = hotspots.table(hotspots.read(path), hotspots.Sources(self.path), order='count')
+        finally:
+            if saved is None:
+                del os.environ['EXPLO_PROFILE']
+            else:
+                os.environ['EXPLO_PROFILE'] = saved
+            os.remove(path)
+        counts = {}
+        for line in report.splitlines()[1:]:
+            fields = line.split()
+            if 'function' in fields:
+                idx = fields.index('function')
+                counts[fields[idx + 2]] = int(fields[idx - 1])
+        for name, count in self.calls:
+            if counts.get(name) != count:
+                raise CallCountMismatch(code, name, count, counts.get(name), report)
 
     def build_code(self, error_idx=None):
         test_lines = list(self.lines)
@@ -97,26 +165,52 @@ class TestFile(object):
         test_code = '\n'.join(test_lines)
         return test_code
 
-    def _check(self, verbose, run_interpreter, run_compiler):
+    def _check(self, verbose, run_interpreter, run_compiler, timings, optimize, variant, binaries, profile,
+               in_process):
         print 'Checking %s' % self.path
+        if self.opt_level is not None:
+            optimize = lambda m: optimizer.optimize(m, self.opt_level, timings=timings)
+            variant = optimizer.variant(self.opt_level)
+        if self.ieee and set(compiler.FAST_MATH_FLAGS) <= set(profile.flags):
+            run_compiler = False
+        # imported modules are looked up next to the test, each build gets fresh models of them
+        loader = lambda: modules.Loader([os.path.dirname(self.path)], output=self, timings=timings, optimize=optimize,
+                                        variant=variant)
         good = self.build_code(None)
         if verbose: print 'Checking normal run'
+        interpreted = compiled = None
         try:
             if verbose: print 'Building model'
-            m = model.build_model(good, self)
+            m = model.build_model(good, self, timings, loader())
+            if optimize:
+                if verbose: print 'Optimizing model'
+                optimize(m)
             if not self.no_run:
                 if run_interpreter:
                     if verbose: print 'Checking interpreter'
-                    self.output = []
-                    model.run_model(m)
-                    self.check_output(good)
+                    interpreted = self.run_interpreter(m, timings)
                 if run_compiler:
                     if verbose: print 'Checking compiler'
-                    self.output = []
-                    compiler.run_model(m)
-                    self.check_output(good)
+                    _, compiled, _ = compiler.run_model(m, timings=timings, cache=binaries, profile=profile,
+                                                        in_process=in_process)
         except Exception as e:
             raise NoSuccess(good, e), None, sys.exc_info()[2]
+        if interpreted is not None:
+            self.check_output('interpreter', good, interpreted)
+        if compiled is not None:
+            self.check_output('compiler', good, compiled)
+        self.check_backends(good, interpreted, compiled)
+        if self.calls and run_compiler and not self.no_run:
+            if verbose: print 'Checking hotspots'
+            try:
+                m = model.build_model(good, self, timings, loader())
+                if optimize:
+                    optimize(m)
+                self.check_calls(good, m, timings, binaries)
+            except TestFailure:
+                raise
+            except Exception as e:
+                raise NoSuccess(good, e), None, sys.exc_info()[2]
 
         for idx, edef in self.errors.items():
             etype, message = edef
@@ -124,7 +218,9 @@ class TestFile(object):
             if verbose: print 'Checking error run: %s %s' % (etype.__name__, message)
             if verbose: print 'Building model'
             try:
-                m = model.build_model(bad, self)
+                m = model.build_model(bad, self, timings, loader())
+                if optimize:
+                    optimize(m)
             except Exception as e:
                 if not issubclass(type(e), etype) or message not in str(e):
                     raise WrongFailure('model', bad, edef, e), None, sys.exc_info()[2]
@@ -136,29 +232,36 @@ class TestFile(object):
             if self.no_run:
                 raise NoFailure(bad, edef)
 
+            interpreted = compiled = None
             if run_interpreter:
                 if verbose: print 'Checking interpreter'
                 try:
-                    model.run_model(m)
+                    self.run_interpreter(m, timings)
                 except Exception as e:
                     if not issubclass(type(e), etype) or message not in str(e):
                         raise WrongFailure('interpreter', bad, edef, e), None, sys.exc_info()[2]
+                    interpreted = ''.join(self.output)
                 else:
                     raise NoFailure('interpreter', bad, edef)
 
             if run_compiler:
                 if verbose: print 'Checking compiler'
                 try:
-                    compiler.run_model(m)
+                    compiler.run_model(m, timings=timings, cache=binaries, profile=profile, in_process=in_process)
                 except error.ExecutionTimeError as e:
                     if not issubclass(type(e), etype) or message not in str(e):
-                        raise WrongFailure('interpreter', bad, edef, e), None, sys.exc_info()[2]
+                        raise WrongFailure('compiler', bad, edef, e), None, sys.exc_info()[2]
+                    if isinstance(e, error.BinaryExecutionError):
+                        compiled = e.args[0][1]
                 else:
                     raise NoFailure('compiler', bad, edef)
+            self.check_backends(bad, interpreted, compiled)
 
-    def check(self, verbose=False, no_interpreter=False, no_compiler=False):
+    def check(self, verbose=False, no_interpreter=False, no_compiler=False, timings=None, optimize=None,
+              variant=None, binaries=None, profile=compiler.DEFAULT_PROFILE, in_process=False):
         try:
-            self._check(verbose, not no_interpreter, not no_compiler)
+            self._check(verbose, not no_interpreter, not no_compiler, timings, optimize, variant, binaries, profile,
+                        in_process)
             return True
         except TestFailure as e:
             if verbose:
@@ -170,15 +273,77 @@ class TestFile(object):
             else:
                 print 'ERROR:', e
 
+class BatchTest(object):
+    # a manifest for batch.py, the trailing comment of each program is how it ends: ok or FAIL <stage>
+    def __init__(self, path, verbose=False):
+        if verbose: print 'Parsing %s' % path
+        self.path = path
+        self.count = 1
+        self.text = open(path).read()
+        self.expected = []
+        base = os.path.dirname(os.path.abspath(path))
+        for line in self.text.splitlines():
+            program, _, expect = line.partition('#')
+            if program.strip():
+                self.expected.append((os.path.join(base, program.strip()), expect.split()))
+
+    def _check(self, verbose, run_compiler, binaries):
+        print 'Checking %s' % self.path
+        if not run_compiler:
+            return
+        output_dir = tempfile.mkdtemp(prefix='batch_')
+        stream = cStringIO.StringIO()
+        report = batch.Report(stream)
+        argv = ['-m', self.path, '-d', output_dir] + (['--cache-dir', binaries.path] if binaries else ['--no-cache'])
+        try:
+            status = batch.main(argv, report)
+            log = stream.getvalue()
+            succeeded = [path for path, expect in self.expected if expect == ['ok']]
+            counts = len(succeeded), len(self.expected) - len(succeeded)
+            if (report.succeeded, report.failed) != counts:
+                raise BatchMismatch(self.text, 'expected %s succeeded and %s failed, got %s' % (
+                    counts + (report.summary(),)), log)
+            if status != (1 if report.failed else 0):
+                raise BatchMismatch(self.text, 'exit status %s' % status, log)
+            for path, expect in self.expected:
+                if expect == ['ok']:
+                    line = 'ok    %s -> %s' % (path, batch.output_path(path, output_dir))
+                else:
+                    line = 'FAIL  %s [%s]' % (path, expect[1])
+                if line not in log:
+                    raise BatchMismatch(self.text, 'reported no %r' % line, log)
+                # a program that failed before gcc leaves no binary, a built one prints what its test expects
+                binary = batch.output_path(path, output_dir)
+                if expect == ['ok']:
+                    _, out, _ = compiler.run_binary(binary)
+                    if out.splitlines() != TestFile(path).expected_output:
+                        raise BatchMismatch(self.text, '%s printed %r' % (binary, out), log)
+                elif expect[1] == 'frontend' and os.path.exists(binary):
+                    raise BatchMismatch(self.text, 'wrote %s' % binary, log)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    def check(self, verbose=False, no_interpreter=False, no_compiler=False, timings=None, optimize=None,
+              variant=None, binaries=None, profile=compiler.DEFAULT_PROFILE, in_process=False):
+        try:
+            self._check(verbose, not no_compiler, binaries)
+            return True
+        except TestFailure as e:
+            if verbose:
+                traceback.print_exc()
+            print 'ERROR:', e
+
 def gather_tests(path, verbose=False):
     
     if os.path.isfile(path):
+        if path.endswith('.manifest'):
+            return [BatchTest(path, verbose)]
         return [TestFile(path, verbose)]
     elif os.path.isdir(path):
         res = []
         for name in os.listdir(path):
             ipath = os.path.join(path, name)
-            if not name.startswith('.') and (os.path.isdir(ipath) or name.endswith('.epl')):
+            if not name.startswith('.') and (os.path.isdir(ipath) or name.endswith(('.epl', '.manifest'))):
                 res += gather_tests(ipath, verbose)
         return res
     else:
@@ -194,7 +359,15 @@ if __name__ == '__main__':
     parser.add_argument('--no-run', action='store_true')
     parser.add_argument('--no-compiler', action='store_true')
     parser.add_argument('--no-interpreter', action='store_true')
+    parser.add_argument('--timings', action='store_true', help='print per-phase timings to stderr')
+    parser.add_argument('--timings-json', metavar='PATH', help='write per-phase timings as json, - for stdout')
+    optimizer.add_arguments(parser)
+    cache.add_arguments(parser)
+    compiler.add_arguments(parser)
     args = parser.parse_args()
+    timings = timing.Timings() if args.timings or args.timings_json else None
+    binaries = cache.from_args(args)
+    optimize = lambda m: optimizer.optimize_from_args(m, args, timings)
     
     test_set = []
     if args.path:
@@ -211,8 +384,16 @@ if __name__ == '__main__':
     for test_file in test_set:
         if not test_file.check(args.verbose,
                                args.no_interpreter or args.no_run,
-                               args.no_compiler or args.no_run):
+                               args.no_compiler or args.no_run,
+                               timings,
+                               optimize,
+                               optimizer.variant_from_args(args),
+                               binaries,
+                               compiler.profile_from_args(args),
+                               args.in_process):
             failed += 1
+    if timings:
+        timing.report(timings, sys.stderr if args.timings else None, args.timings_json)
     if failed:
         print '%s tests failed' % failed
         sys.exit(1)
@@ -0,0 +1,131 @@
+import os
+import time
+import json
+import contextlib
+import collections
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def _cpu_time():
+    # children times are included, so gcc and compiled binaries are accounted too
+    if resource:
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+def _memory_start():
+    if tracemalloc:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+    elif resource:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return 0
+
+def _memory_peak(start):
+    if tracemalloc:
+        return max(0, tracemalloc.get_traced_memory()[1] - start)
+    elif resource:
+        return max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - start)
+    return 0
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.memory = 0
+        self.counts = collections.OrderedDict()
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def as_dict(self):
+        return collections.OrderedDict((
+            ('name', self.name),
+            ('calls', self.calls),
+            ('wall', self.wall),
+            ('cpu', self.cpu),
+            ('memory', self.memory),
+            ('counts', self.counts),
+        ))
+
+class Timings(object):
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.info = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = Phase(name)
+        phase = self.phases[name]
+        memory = _memory_start()
+        cpu = _cpu_time()
+        wall = time.time()
+        try:
+            yield phase
+        finally:
+            phase.wall += time.time() - wall
+            phase.cpu += _cpu_time() - cpu
+            phase.memory = max(phase.memory, _memory_peak(memory))
+            phase.calls += 1
+
+    def as_dict(self):
+        return collections.OrderedDict((
+            ('info', self.info),
+            ('phases', [p.as_dict() for p in self.phases.values()]),
+            ('total', collections.OrderedDict((
+                ('wall', sum(p.wall for p in self.phases.values())),
+                ('cpu', sum(p.cpu for p in self.phases.values())),
+            ))),
+        ))
+
+    def json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def table(self):
+        rows = [('phase', 'calls', 'wall ms', 'cpu ms', 'peak mem KiB', 'counts')]
+        for p in self.phases.values():
+            counts = ', '.join('%s=%s' % item for item in p.counts.items())
+            rows.append((p.name, str(p.calls), '%.2f' % (p.wall * 1000), '%.2f' % (p.cpu * 1000),
+                         '%.1f' % (p.memory / 1024.0), counts))
+        total = self.as_dict()['total']
+        rows.append(('total', '', '%.2f' % (total['wall'] * 1000), '%.2f' % (total['cpu'] * 1000), '', ''))
+        widths = [max(len(row[idx]) for row in rows) for idx in range(len(rows[0]) - 1)]
+        lines = ['%s: %s' % item for item in self.info.items()]
+        for row in rows:
+            cells = [cell.ljust(width) if idx == 0 else cell.rjust(width)
+                     for idx, (cell, width) in enumerate(zip(row, widths))]
+            lines.append('  '.join(cells + [row[-1]]).rstrip())
+        return '\n'.join(lines)
+
+class NullTimings(Timings):
+    @contextlib.contextmanager
+    def phase(self, name):
+        yield Phase(name)
+
+NULL_TIMINGS = NullTimings()
+
+def report(timings, table_stream=None, json_path=None):
+    if table_stream:
+        table_stream.write(timings.table() + '\n')
+    if json_path:
+        if json_path == '-':
+            print timings.json()
+        else:
+            with open(json_path, 'w') as f:
+                f.write(timings.json() + '\n')
@@ -1,67 +1,131 @@
 #!env python2.7
 import sys
+import cStringIO
 import contextlib
 import model
 import error
+import modules
 
 RESERVED_NAMES = ('main', 'unit', 'false', 'true')
 
 class Output(object):
-    def __init__(self, indent=False):
-        self.indent = indent
-        self.res = []
-        self.newline = True
+    # a segment of the generated source; segments can be filled in any order,
+    # the text is produced once by write() when the whole tree is complete
+    __slots__ = ('depth', 'items', 'current', 'last')
+
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.items = []
+        self.current = None
+        self.last = None
 
     def inserter(self, indent=False):
-        op = Output(indent)
-        self.res.append(op)
-        self.newline = True
+        op = Output(self.depth + 1 if indent else self.depth)
+        self.items.append(op)
+        self.current = None
         return op
 
     def string(self, s):
         if not s:
             return
-        if self.newline:
-            self.res.append(s)
-            self.newline = False
+        if self.current is None:
+            self.current = [s]
+            self.items.append(self.current)
         else:
             space = True
             first = s[0]
-            last = self.res[-1][-1]
-            if first in '();,':
+            if first in '();,.':
                 space = False
-            if last in '()':
+            if self.last in '(!':
                 space = False
-            if first == '{' and last == ')':
+            if first == '(' and self.last in '=+-*/%<>&|':
                 space = True
             if space:
-                s = ' ' + s
-            self.res[-1] += s
-        
+                self.current.append(' ')
+            self.current.append(s)
+        self.last = s[-1]
+
     def line(self, s):
         self.string(s)
-        self.newline = True
+        self.current = None
+
+    def flush(self, stream, written):
+        # only for segments nothing will be inserted into anymore
+        self.write(stream, written)
+        self.items = []
+        self.current = None
+
+    def write(self, stream, written=None):
+        # lines are separated, not terminated, so the count of lines written so far is shared
+        if written is None:
+            written = [0]
+        for item in self.items:
+            if isinstance(item, Output):
+                item.write(stream, written)
+                continue
+            if written[0]:
+                stream.write('\n')
+            written[0] += 1
+            if self.depth:
+                stream.write('  ' * self.depth)
+            stream.write(''.join(item))
+        return written[0]
 
     def __str__(self):
-        res = '\n'.join(filter(bool, map(str, self.res)))
-        if self.indent:
-            lines = res.splitlines(True)
-            return ''.join('  ' + l for l in lines)
-        else:
-            return res
+        buf = cStringIO.StringIO()
+        self.write(buf)
+        return buf.getvalue()
 
 class State(object):
     flags = ('in_function', 'in_loop')
     
-    def __init__(self):
+    def __init__(self, stream=None, static=False, shared=False, module=None, linked=(), instrument=False):
         for key in self.flags:
             setattr(self, key, False)
-        self.temp_idx = 0
+        self.scope = None
+        self.counters = {}
         self.main = None
+        self.stream = stream
+        self.static = static
+        # shared objects are run repeatedly in one process, mutable globals get reinitialized
+        self.shared = shared
+        self.globals = []
+        self.written = [0]
+        # a module of a program built from several, it is compiled on its own and linked with the others;
+        # the program entry point is the unit without a module name, it resets the linked ones
+        self.module = module
+        self.linked = linked
+        self.exports = {}
+        # probes are file scope counters, they go to the declarations segment of the current definition
+        self.instrument = instrument
+        self.probes = []
+        self.declarations = None
+        self.function_names = {}
+        self.function_name = None
+        # C names of record types, equal anonymous records share a struct
+        self.records = {}
+        self.enums = {}
+
+    def probe(self, kind, name, ast_node):
+        var = self.unique_name('probe')
+        line = ast_node.srcmap[0] if ast_node is not None and ast_node.srcmap else 0
+        self.declarations.line('static explo_probe %s = {"%s", "%s", "%s", %s};' % (
+            var, kind, self.module or '', name, line))
+        self.probes.append(var)
+        return var
+
+
+    def flush(self, output):
+        if self.stream:
+            output.flush(self.stream, self.written)
 
     def unique_name(self, name):
-        self.temp_idx += 1
-        return '__%s_%s' % (name, self.temp_idx)
+        # numbered per top level definition, so editing one leaves names in the others intact
+        idx = self.counters.get(self.scope, 0) + 1
+        self.counters[self.scope] = idx
+        if self.scope is None:
+            return '__%s_%s' % (name, idx)
+        return '__%s_%s_%s' % (name, self.scope, idx)
 
     def temp_var(self, name, type, output):
         varname = self.unique_name(name)
@@ -83,6 +147,12 @@ class State(object):
         for name, value in old.items():
             setattr(self, name, value)
 
+def reset_name(module=None):
+    # reinitializes mutable globals of a shared object, the one of the entry point calls the others
+    if module is None:
+        return '__explo_reset'
+    return modules.symbol(module, '_reset')
+
 def patch(fn):
     tname, mname = fn.__name__.split('_')
     type = getattr(model, tname)
@@ -140,8 +210,25 @@ def Block_transpile(self, tstate, prelude, body, result):
 @patch
 def Program_transpile(self, tstate, prelude, body, result):
     prelude.line('#include "builtins.h"')
-    for st in self.statements:
+    tstate.declarations = prelude.inserter()
+    for extern in self.externs:
+        extern.type.return_type.transpile(tstate, prelude.inserter(), prelude.inserter(), prelude)
+        prelude.string(extern.name)
+        prelude.string('(')
+        for idx, atype in enumerate(extern.type.arg_types):
+            if idx != 0:
+                prelude.string(',')
+            atype.transpile(tstate, prelude.inserter(), prelude.inserter(), prelude)
+        prelude.line(');')
+    if tstate.module is not None:
+        tstate.exports = modules.export_symbols(self, tstate.module)
+    tstate.flush(prelude)
+    for idx, st in enumerate(self.statements):
+        tstate.scope = st.name if isinstance(st, model.VarDef) else 'top%s' % idx
+        tstate.declarations = body.inserter()
+        # definitions only add to their own segments, each is complete once transpiled
         st.transpile(tstate, body.inserter(), body.inserter(), None)
+        tstate.flush(body)
 
 @patch
 def FuncType_transpile(self, tstate, prelude, body, result):
@@ -159,8 +246,76 @@ def FuncType_transpile(self, tstate, prelude, body, result):
         body.string(');')
     result.string(self.transname)
 
+def record_name(tstate, record):
+    # structs are file scope, they are declared before the definition that uses them first
+    if record not in tstate.records:
+        fields = []
+        for name, ftype in record.fields:
+            field = Output()
+            ftype.transpile(tstate, tstate.declarations.inserter(), tstate.declarations, field)
+            fields.append('%s %s;' % (field, field_name(name)))
+        tstate.records[record] = tstate.unique_name('record')
+        tstate.declarations.line('typedef struct {%s} %s;' % (''.join(' ' + f for f in fields) + ' ' if fields else '',
+                                                                 tstate.records[record]))
+    return tstate.records[record]
+
+def field_name(name):
+    # tuple fields are named by position
+    return name if name[0].isalpha() else '_' + name
+
+@patch
+def RecordType_transpile(self, tstate, prelude, body, result):
+    result.string(record_name(tstate, self))
+
+def record_literal(tstate, record, fields, prelude, result):
+    result.string('(%s){' % record_name(tstate, record))
+    for idx, field in enumerate(fields):
+        if idx != 0:
+            result.string(',')
+        field.transpile(tstate, prelude.inserter(), prelude.inserter(), result)
+    result.string('}')
+
+def record_initializer(tstate, value, prelude, result):
+    # compound literals are not constant, nested records of a file scope initializer are plain braces
+    result.string('{')
+    for idx, field in enumerate(value.fields):
+        if idx != 0:
+            result.string(',')
+        if isinstance(field, model.RecordValue):
+            record_initializer(tstate, field, prelude, result)
+        else:
+            field.transpile(tstate, prelude.inserter(), prelude.inserter(), result)
+    result.string('}')
+
+@patch
+def RecordValue_transpile(self, tstate, prelude, body, result):
+    record_literal(tstate, self.type, self.fields, prelude, result or body)
+
+@patch
+def Construct_transpile(self, tstate, prelude, body, result):
+    record_literal(tstate, self.type, self.args, prelude, result or body)
+    if result is None:
+        body.line(';')
+
+@patch
+def Field_transpile(self, tstate, prelude, body, result):
+    out = result or body
+    self.obj.transpile(tstate, prelude.inserter(), prelude.inserter(), out)
+    out.string('.' + field_name(self.name))
+    if result is None:
+        body.line(';')
+
 @patch
 def VarDef_transpile(self, tstate, prelude, body, result):
+    if isinstance(model.unwrap(self.value), model.RecordType):
+        # types only exist in C declarations
+        record_name(tstate, model.unwrap(self.value))
+        return
+    if isinstance(model.unwrap(self.value), model.Enum):
+        enum_name(tstate, model.unwrap(self.value))
+        return
+    if tstate.static and self.owner is None:
+        body.string('static')
     if self.readonly:
         body.string('const')
     self.type.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
@@ -173,38 +328,74 @@ def VarDef_transpile(self, tstate, prelude, body, result):
         body.string(self.name)
     if self.value:
         body.string('=')
-        self.value.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
+        value = self.value.value if isinstance(self.value, model.PrecompiledExpression) else self.value
+        if isinstance(value, model.Function):
+            tstate.function_names.setdefault(value, (self.name, self.ast_node))
+        if isinstance(value, model.RecordValue):
+            record_initializer(tstate, value, prelude, body)
+        else:
+            self.value.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
+        if tstate.shared and self.owner is None and not self.readonly:
+            tstate.globals.append(self)
     body.line(';')
 
+def enum_name(tstate, enum):
+    # members are declared in code order, so C values equal the codes
+    if enum not in tstate.enums:
+        name = tstate.unique_name('enum')
+        tstate.enums[enum] = name
+        members = ['%s_%s' % (name, value) for value in enum.values]
+        tstate.declarations.line('typedef enum {%s} %s;' % (', '.join(members or [name + '_empty']), name))
+    return tstate.enums[enum]
+
 @patch
 def Enum_transpile(self, tstate, prelude, body, result):
-    body.string('typedef enum')
-    body.string('{')
-    for idx, value in enumerate(self.type.values):
-        if idx != 0:
-            body.string(',')
-        body.string(value.value)
-    if not self.type.values:
-        body.string('empty')
-    body.string('}')
-    body.string(self.type.name)
-    body.line(';')
+    result.string(enum_name(tstate, self))
+
+def integer_literal(value, type):
+    # 64 bit constants don't fit a plain C literal, the smallest signed one can't be written at all
+    if isinstance(type, model.PrecompiledExpression):
+        type = type.value
+    if getattr(type, 'bits', None) != 64:
+        return str(value)
+    if not type.signed:
+        return 'UINT64_C(%d)' % value
+    if value == -2 ** 63:
+        return 'INT64_MIN'
+    return 'INT64_C(%d)' % value
+
+def float_literal(value):
+    # repr is the shortest exact form, values folded at compile time may be infinite or nan
+    if value != value:
+        return '__builtin_nan("")'
+    if value in (float('inf'), float('-inf')):
+        return '__builtin_inf()' if value > 0 else '(-__builtin_inf())'
+    return repr(value)
 
 @patch
 def Value_transpile(self, tstate, prelude, body, result):
     if result:
         if isinstance(self.value, bool):
             result.string(str(self.value).lower())
+        elif isinstance(self.value, float):
+            result.string(float_literal(self.value))
+        elif isinstance(model.unwrap(self.type), model.Enum):
+            enum = model.unwrap(self.type)
+            result.string('%s_%s' % (enum_name(tstate, enum), enum.values[self.value]))
         else:
-            result.string(str(self.value))
+            result.string(integer_literal(self.value, self.type))
     return True
 
 @patch
 def Function_transpile(self, tstate, prelude, body, result):
     if not hasattr(self, 'transname'):
-        setattr(self, 'transname', tstate.unique_name('function'))
+        exported = tstate.exports.get(self)
+        setattr(self, 'transname', exported or tstate.unique_name('function'))
         
         prelude, body = prelude.inserter(), prelude.inserter()
+        # nested functions are a gcc extension, they can't be static
+        if tstate.static and not tstate.in_function and not exported:
+            body.string('static')
         self.return_type.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
         body.string(self.transname)
         body.string('(')
@@ -212,18 +403,37 @@ def Function_transpile(self, tstate, prelude, body, result):
             if idx != 0:
                 body.string(',')
             arg.type.transpile(tstate, prelude, prelude, body)
+            if arg.by_ref:
+                # the model rejects calls passing a variable twice or one the callee uses itself
+                body.string('*restrict')
             body.string(arg.name)
         body.string(') {')
+        name, node = tstate.function_names.get(self, (self.transname, self.ast_node))
+        probe = None
+        if tstate.instrument:
+            probe = tstate.probe('function', name, node)
+            body.inserter(True).line('unsigned long long __explo_start = explo_enter(&%s);' % probe)
+        outer_name, tstate.function_name = tstate.function_name, name
         with tstate.set_flags(in_function=True):
             if not model.is_unit_type(self.return_type):
                 bodypre = body.inserter(True)
                 bodybody = body.inserter(True)
                 bodyresult = body.inserter(True)
-                bodyresult.string('return')
+                if probe:
+                    self.return_type.transpile(tstate, bodypre.inserter(), bodypre.inserter(), bodyresult)
+                    bodyresult.string('__explo_result =')
+                else:
+                    bodyresult.string('return')
                 self.body.transpile(tstate, bodypre, bodybody, bodyresult)
                 bodyresult.line(';')
+                if probe:
+                    bodyresult.line('explo_leave(&%s, __explo_start);' % probe)
+                    bodyresult.line('return __explo_result;')
             else:
                 self.body.transpile(tstate, body.inserter(True), body.inserter(True), None)
+                if probe:
+                    body.inserter(True).line('explo_leave(&%s, __explo_start);' % probe)
+        tstate.function_name = outer_name
         body.line('};')
         
     result.string(self.transname)
@@ -232,16 +442,51 @@ def Function_transpile(self, tstate, prelude, body, result):
 @patch
 def VarRef_transpile(self, tstate, prelude, body, result):
     if result:
-        if hasattr(self.var_def, 'transname'):
+        if self.var_def.by_ref:
+            result.string('(*%s)' % self.var_def.name)
+        elif hasattr(self.var_def, 'transname'):
             result.string(self.var_def.transname)
         else:
             result.string(self.var_def.name)
 
+@patch
+def RefType_transpile(self, tstate, prelude, body, result):
+    self.target.transpile(tstate, prelude, body, result)
+    result.string('*')
+
 @patch
 def While_transpile(self, tstate, prelude, body, result):
     body.string('while (')
     self.condition.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
     body.string(')')
+    with tstate.set_flags(in_loop=True):
+        if tstate.instrument:
+            probe = tstate.probe('loop', tstate.function_name or '', self.ast_node)
+            body.line('{')
+            indented = body.inserter(True)
+            indented.line('++%s.count;' % probe)
+            self.body.transpile(tstate, prelude, indented, None)
+            body.line('}')
+        else:
+            self.body.transpile(tstate, prelude, body, None)
+
+OMP_REDUCTIONS = {'sum': '+', 'product': '*', 'min': 'min', 'max': 'max'}
+
+@patch
+def Parallel_transpile(self, tstate, prelude, body, result):
+    # bounds are evaluated once, before the threads start
+    lo = tstate.temp_var('parallel_lo', self.var.type, prelude)
+    hi = tstate.temp_var('parallel_hi', self.var.type, prelude)
+    for name, bound in ((lo, self.lo), (hi, self.hi)):
+        body.string(name)
+        body.string('=')
+        bound.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
+        body.line(';')
+    body.line(' '.join(['#pragma omp parallel for'] + ['reduction(%s:%s)' % (OMP_REDUCTIONS[kind], var.name)
+                                                        for kind, var in self.reductions]))
+    body.string('for (')
+    self.var.type.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
+    body.string('%s = %s; %s < %s; ++%s)' % (self.var.name, lo, self.var.name, hi, self.var.name))
     with tstate.set_flags(in_loop=True):
         self.body.transpile(tstate, prelude, body, None)
 
@@ -283,35 +528,136 @@ def If_transpile(self, tstate, prelude, body, result):
     if outvar:
         result.string(outvar)
 
+@patch
+def Match_transpile(self, tstate, prelude, body, result):
+    if result and self.type:
+        outvar = tstate.temp_var('match_result', self.type, prelude)
+    else:
+        outvar = None
+    enum = model.unwrap(self.value.type)
+    name = enum_name(tstate, enum)
+    body.string('switch (')
+    self.value.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
+    body.line(') {')
+    for idx, arm in enumerate(self.arms):
+        for code, arm_idx in enumerate(self.table):
+            if arm_idx == idx:
+                body.line('case %s_%s:' % (name, enum.values[code]))
+        # a declaration can't follow a label directly
+        block = body.inserter(True)
+        block.line('{')
+        indented = block.inserter(True)
+        if outvar:
+            cpre = indented.inserter()
+            cbody = indented.inserter()
+            indented.string(outvar)
+            indented.string('=')
+            arm.transpile(tstate, cpre, cbody, indented)
+            indented.line(';')
+        else:
+            arm.transpile(tstate, indented.inserter(), indented.inserter(), None)
+        block.line('} break;')
+    # the model only creates codes of the enum, gcc can drop the range check of the jump table
+    body.line('default:')
+    body.inserter(True).line('__builtin_unreachable();')
+    body.line('}')
+
+    if outvar:
+        result.string(outvar)
+
+BINARY_OPERATORS = {
+    # div and mod stay calls, the runtime checks for division by zero
+    'add': '+', 'sub': '-', 'mul': '*',
+    'ieq': '==', 'ineq': '!=', 'gt': '>', 'geq': '>=', 'lt': '<', 'leq': '<=',
+    # both operands are evaluated, like arguments of a call
+    'and': '&', 'or': '|', 'xor': '!=', 'beq': '==', 'bneq': '!=',
+}
+UNARY_OPERATORS = {
+    'not': '!',
+}
+
+def builtin_operator(callee):
+    if isinstance(callee, model.PrecompiledExpression):
+        callee = callee.value
+    if isinstance(callee, model.Builtin):
+        return BINARY_OPERATORS.get(callee.name) or UNARY_OPERATORS.get(callee.name)
+
 @patch
 def Call_transpile(self, tstate, prelude, body, result):
     if result is None:
         result = body
+    operator = builtin_operator(self.callee)
+    if operator:
+        # always parenthesized, so nesting never depends on C precedence
+        result.string('(')
+        if len(self.args) == 2:
+            self.args[0].transpile(tstate, prelude.inserter(), prelude.inserter(), result)
+            result.string(operator)
+            self.args[1].transpile(tstate, prelude.inserter(), prelude.inserter(), result)
+        else:
+            result.string(operator)
+            self.args[0].transpile(tstate, prelude.inserter(), prelude.inserter(), result)
+        result.string(')')
+        if result == body:
+            result.line(';')
+        return
     self.callee.transpile(tstate, prelude.inserter(), prelude.inserter(), result)
     result.string('(')
-    for idx, arg in enumerate(self.args):
+    for idx, (ref, arg) in enumerate(zip(self.refs, self.args)):
         if idx != 0:
             result.string(',')
-        arg.transpile(tstate, prelude.inserter(), prelude.inserter(), result)
+        if ref and arg.var_def.by_ref:
+            result.string(arg.var_def.name)
+        elif ref:
+            result.string('&' + getattr(arg.var_def, 'transname', arg.var_def.name))
+        else:
+            arg.transpile(tstate, prelude.inserter(), prelude.inserter(), result)
     result.string(')')
     if result == body:
         result.line(';')
 
 @patch
 def Assignment_transpile(self, tstate, prelude, body, result):
-    body.string(self.destination.name)
+    body.string(('*' if self.destination.by_ref else '') + self.destination.name)
     body.string('=')
     self.value.transpile(tstate, prelude.inserter(), prelude.inserter(), body)
     body.line(';')
 
-def transpile_model(m):
-    tstate = State()
+def transpile_output(m, tstate=None):
+    tstate = tstate or State()
     output = Output()
     m.transpile(tstate, output.inserter(), output.inserter(), None)
-    if tstate.main:
+    if tstate.main and tstate.module is None:
         tstate.main.type.return_type.transpile(tstate, output.inserter(), output.inserter(), output)
-        output.string('main() { return %s(); }' % tstate.main.transname)
-    return str(output)
+        output.line('main() { return %s(); }' % tstate.main.transname)
+    if tstate.instrument:
+        output.line('static explo_probe* __explo_probes[] = {%s};' % (
+            ', '.join('&' + probe for probe in tstate.probes) or '0'))
+        output.line('__attribute__((destructor)) static void __explo_dump() { explo_dump(__explo_probes, %s); }' % (
+            len(tstate.probes)))
+    if tstate.shared:
+        for name in tstate.linked:
+            output.line('void %s();' % name)
+        output.line('void %s() {' % reset_name(tstate.module))
+        indented = output.inserter(True)
+        for name in tstate.linked:
+            indented.line('%s();' % name)
+        for var in tstate.globals:
+            indented.string(getattr(var, 'transname', var.name))
+            indented.string('=')
+            var.value.transpile(tstate, indented.inserter(), indented.inserter(), indented)
+            indented.line(';')
+        output.line('}')
+    return output
+
+def transpile_model(m, stream=None, static=False, shared=False, module=None, linked=(), instrument=False):
+    # with a stream, each top level definition is written as soon as it is transpiled
+    if stream is None:
+        return str(transpile_output(m, State(static=static, shared=shared, module=module, linked=linked,
+                                             instrument=instrument)))
+    tstate = State(stream, static, shared, module, linked, instrument)
+    transpile_output(m, tstate).flush(stream, tstate.written)
+    return tstate.written[0]
 
 if __name__ == '__main__':
     import sys
@@ -319,11 +665,14 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
     import argparse
+    import optimizer
     parser = argparse.ArgumentParser()
     parser.add_argument('path')
+    optimizer.add_arguments(parser)
     args = parser.parse_args()
     
     content = open(args.path).read()
 
     m = model.build_model(content)
+    optimizer.optimize_from_args(m, args)
     print transpile_model(m)